@@ -0,0 +1,128 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime, timezone
+from psycopg2.extras import execute_values
+from server import transaction
+
+
+class RequestLogWriter:
+
+    def __init__(
+            self,
+            max_queued : int = 10000,
+            batch_size : int = 500,
+            flush_interval : float = 1.0
+        ):
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+        self.logged = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+
+        self._thread = threading.Thread(target=self._run, name="request-log", daemon=True)
+        self._thread.start()
+
+    def log(self, content, kind, user_id):
+        # Never blocks a search: a full buffer drops the record instead
+        try:
+            if self._closed.is_set():
+                raise queue.Full
+            self._queue.put_nowait((datetime.now(timezone.utc), content, kind, user_id))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        with self._lock:
+            self.logged += 1
+        return True
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while True:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+            if self._closed.is_set() and self._queue.empty():
+                self._flush(batch)
+                return
+
+    def _flush(self, batch):
+        if not batch:
+            return
+
+        try:
+            with transaction() as cursor:
+                execute_values(
+                    cursor,
+                    "INSERT INTO requests (created_at, content, type, user_id) VALUES %s",
+                    batch,
+                    page_size=self.batch_size
+                )
+            self.written += len(batch)
+            self.flushes += 1
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Error writing {len(batch)} request logs: {e}")
+
+    def close(self, timeout : float = 5.0):
+        self._closed.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'max_queued': self._queue.maxsize,
+            'logged': self.logged,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'flushes': self.flushes
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_request_log():
+    global _writer
+
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = RequestLogWriter(
+                    max_queued=int(os.getenv('REQUEST_LOG_MAX_QUEUED', 10000)),
+                    batch_size=int(os.getenv('REQUEST_LOG_BATCH_SIZE', 500)),
+                    flush_interval=float(os.getenv('REQUEST_LOG_FLUSH_INTERVAL', 1.0))
+                )
+                # Flush whatever is buffered when the process exits
+                atexit.register(_writer.close)
+    return _writer
+
+def log_request(content, kind, user_id):
+    return get_request_log().log(content, kind, user_id)
+
+def request_log_stats():
+    if _writer is None:
+        return None
+    return _writer.stats()
@@ -1,23 +1,62 @@
-import threading
+import os
+import time
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from getForDocument import get_matches_for_doc
 from getForPhrase import get_matches_for_phrase
 from getForURL import get_matches_for_url
 from getForWords import get_matches_for_words
+from getForBulk import stream_matches_for_phrases
 from getOpposite import get_opposite
-from processURL import process_url
-from server import exists_in_table, get_data_from_db
+from retrieval import FUSIONS
+from ingest import get_scheduler, scheduler_stats, QueueFull
+from processURL import enqueue_url
+from dedup import canonicalize_url
+from server import exists_in_table, pool_stats
+from cache import embedding_cache_stats, result_cache_stats
+from snippets import snippet_cache_stats
+from analytics import request_log_stats
+from stats import get_stats, timed, record_latency
+from metrics import start_profile, resume_profile, observe_request, render_metrics
 
 
 load_dotenv()
 app = Flask(__name__)
 
+@app.before_request
+def startProfile():
+    g.started_at = time.perf_counter()
+    g.profile = start_profile(
+        request.headers.get('X-Profile', '').lower() in ('1', 'true')
+        or request.args.get('profile', '').lower() in ('1', 'true')
+    )
+
+@app.after_request
+def recordTiming(response):
+    # A streamed body hasn't been produced yet; its route records its own timing
+    if response.is_streamed:
+        return response
+
+    if 'started_at' in g:
+        observe_request(request.url_rule.rule if request.url_rule else 'unmatched', time.perf_counter() - g.started_at)
+
+    profile = g.get('profile')
+    if profile is not None:
+        response.headers['Server-Timing'] = profile.server_timing()
+        body = response.get_json(silent=True)
+        if isinstance(body, dict):
+            body['profile'] = profile.summary()
+            response.set_data(app.json.dumps(body))
+
+    return response
+
 @app.route('/get/phrase', methods=['GET'])
+@timed('phrase')
 def getWithWords():
     try: 
         phrase = request.args['sentence']
         user_id = request.args['user_id']
+        include_text = request.args.get('include_text', '').lower() in ('1', 'true')
 
     except Exception as e:
         return jsonify({
@@ -25,10 +64,11 @@ def getWithWords():
             'message': f"Missing params:, {e}"
         }), 400
     
-    result = get_matches_for_phrase(phrase, user_id)
+    result = get_matches_for_phrase(phrase, user_id, include_text)
     return jsonify(result), result['status']
 
 @app.route('/get/url', methods=['GET'])
+@timed('url')
 def getThroughURL():
     try:
         url = request.json.get('url')
@@ -49,13 +89,20 @@ def getThroughURL():
     return jsonify(result), result['status']
 
 @app.route('/get/opposite', methods=['GET'])
+@timed('opposite')
 def getOpposite():
     try:
         phrase = request.json.get('sentence')
         user_id = request.json.get('user_id')
+        rerank = request.json.get('rerank')
+        include_text = bool(request.json.get('include_text', False))
 
         if phrase is None or user_id is None:
             raise Exception("Phrase or user_id must be provided")
+        if rerank is not None:
+            rerank = int(rerank)
+            if rerank < 1:
+                raise Exception("rerank must be a positive oversampling factor")
         
     except Exception as e:
         print(e)
@@ -64,13 +111,16 @@ def getOpposite():
             'message': f'Error in parsing the query: {str(e)}'
         }), 500
     
-    result = get_opposite(phrase, user_id)
+    result = get_opposite(phrase, user_id, rerank, include_text)
     return jsonify(result), result['status']
 
 @app.route('/get/words', methods=['GET'])
+@timed('words')
 def getThroughWords():
     words = request.json['words']
     user_id = request.json['user_id']
+    fusion = request.json.get('fusion', 'rrf')
+    include_text = bool(request.json.get('include_text', False))
     
     if not words:
         return jsonify({
@@ -78,10 +128,17 @@ def getThroughWords():
             'message': 'Words list cannot be empty'
         }), 400
 
-    result = get_matches_for_words(words, user_id)
+    if fusion not in FUSIONS:
+        return jsonify({
+            'status': 400,
+            'message': f"Fusion must be one of {', '.join(FUSIONS)}"
+        }), 400
+
+    result = get_matches_for_words(words, user_id, fusion, include_text)
     return jsonify(result), result['status']
 
 @app.route('/get/document', methods=['GET'])
+@timed('document')
 def getThroughDoc():
     doc = request.json['document']
     user_id = request.json['user_id']
@@ -89,6 +146,48 @@ def getThroughDoc():
     result = get_matches_for_doc(doc, user_id)
     return jsonify(result), result['status']
 
+@app.route('/get/bulk', methods=['GET'])
+def getBulk():
+    try:
+        phrases = request.json.get('sentences')
+        user_id = request.json.get('user_id')
+        include_text = bool(request.json.get('include_text', False))
+
+        if user_id is None:
+            raise Exception("user_id must be provided")
+        if not isinstance(phrases, list) or not phrases or not all(isinstance(phrase, str) and phrase for phrase in phrases):
+            raise Exception("sentences must be a non-empty list of strings")
+
+        max_queries = int(os.getenv('BULK_MAX_QUERIES', 100))
+        if len(phrases) > max_queries:
+            raise Exception(f"At most {max_queries} sentences per request")
+
+    except Exception as e:
+        return jsonify({
+            'status': 400,
+            'message': f"Error parsing message, {e}"
+        }), 400
+
+    started_at = g.started_at
+    profile = g.get('profile')
+
+    # One JSON object per line, flushed as each sentence's results are ready.
+    # Timing is recorded once the last line is out, and a requested profile
+    # follows as a final line since the headers are long gone by then.
+    def lines():
+        resume_profile(profile)
+        try:
+            for result in stream_matches_for_phrases(phrases, user_id, include_text):
+                yield app.json.dumps(result) + "\n"
+            if profile is not None:
+                yield app.json.dumps({'profile': profile.summary()}) + "\n"
+        finally:
+            elapsed = time.perf_counter() - started_at
+            observe_request('/get/bulk', elapsed)
+            record_latency('bulk', elapsed)
+
+    return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
 @app.route('/post/url', methods=['POST'])
 def sendURL():
     try:
@@ -97,8 +196,7 @@ def sendURL():
 
         if user_id is None or url is None:
             raise Exception("No URL or user ID provided")
-        if url.endswith('/'):
-            url = url[:-1]
+        url = canonicalize_url(url)
 
     except Exception as e:
         print(e)
@@ -107,14 +205,22 @@ def sendURL():
             'message': f"Error in parsing query parameters, {e}."
         }), 400
 
-    # Start processing in a separate thread
-    thread = threading.Thread(target=process_url_async, args=(url, user_id))
-    thread.start()
+    if os.getenv('INGEST_MODE') == 'queue':
+        return queue_urls([url], user_id)
+
+    try:
+        job_id = get_scheduler().submit([url], user_id)
+    except QueueFull as e:
+        return jsonify({
+            'status': 429,
+            'message': f"Ingestion queue is full, {e}."
+        }), 429
 
     # Immediately return a 200 status
     return jsonify({
         'status': 200,
-        'message': "URL accepted for processing"
+        'message': "URL accepted for processing",
+        'job_id': job_id
     }), 200
 
 @app.route('/post/bulk', methods=['POST'])
@@ -124,6 +230,7 @@ def sendMultipleURLs():
         urls = request.json.get('urls')
         if not isinstance(urls, list):
             raise ValueError("URLs must be provided as a list")
+        urls = [canonicalize_url(url) for url in urls]
         
     except Exception as e:
         return jsonify({
@@ -131,12 +238,43 @@ def sendMultipleURLs():
             'message': f"Error in parsing query parameters: {e}."
         }), 400
 
-    thread = threading.Thread(target=process_urls_async, args=(urls, user_id))
-    thread.start()
+    if os.getenv('INGEST_MODE') == 'queue':
+        return queue_urls(urls, user_id)
+
+    try:
+        job_id = get_scheduler().submit(urls, user_id)
+    except QueueFull as e:
+        return jsonify({
+            'status': 429,
+            'message': f"Ingestion queue is full, {e}."
+        }), 429
+
+    return jsonify({
+        'status': 200,
+        'message': f"{len(urls)} URLs accepted for processing",
+        'job_id': job_id
+    }), 200
+
+@app.route('/get/job/<job_id>', methods=['GET'])
+def getJobStatus(job_id):
+    # Jobs live in the memory of the process that accepted them: with several
+    # server workers, or after a restart, an id can be unknown here even
+    # though the job exists. INGEST_MODE=queue keeps ingestion durable.
+    job = get_scheduler().job_status(job_id)
+
+    if job is None:
+        return jsonify({
+            'status': 404,
+            'message': (
+                f"No ingestion job with id {job_id} in this server process. "
+                "Job status is kept in memory by the process that accepted the job, "
+                "so it is not shared between server workers and is lost on restart."
+            )
+        }), 404
 
     return jsonify({
         'status': 200,
-        'message': f"{len(urls)} URLs accepted for processing"
+        'message': job
     }), 200
 
 @app.route('/get/stats', methods=['GET'])
@@ -157,10 +295,9 @@ def getStats () :
     #     })
     
     try:
-        no_of_links = get_data_from_db("SELECT COUNT(*) FROM pages")
-        no_of_requests = get_data_from_db("SELECT COUNT(*) FROM requests")
-        no_in_queue = get_data_from_db("SELECT COUNT(*) FROM queue")
-    except:
+        stats = get_stats()
+    except Exception as e:
+        print(f"Error in retrieving stats: {e}")
         return jsonify({
             'status': 500,
             'message': "Internal Server Error (in retrieving values from Db)"
@@ -169,29 +306,40 @@ def getStats () :
     return jsonify({
         'status': 200,
         'message': {
-            'links_added': no_of_links,
-            'searches': no_of_requests,
-            'links_in_queue': no_in_queue
+            **stats,
+            'db_pool': pool_stats(),
+            'embedding_cache': embedding_cache_stats(),
+            'snippet_cache': snippet_cache_stats(),
+            'result_cache': result_cache_stats(),
+            'request_log': request_log_stats(),
+            'ingestion': scheduler_stats()
         }
     })
-   
-    
-def process_urls_async(urls, user_id):
+
+
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def queue_urls(urls, user_id):
+    # Durable mode: rows go into the queue table and worker.py processes them
     results = []
     for url in urls:
-        result = process_url(url, user_id)
-        results.append({
-            'url': url,
-            'status': result['status'],
-            'message': result['message']
-        })
-    
-    print(f"URLs processing results: {results}")
- 
-def process_url_async(url, user_id):
-    result = process_url(url, user_id)
-    
-    print(f"URL processing result: {result}")
+        try:
+            result = enqueue_url(url, user_id)
+        except Exception as e:
+            result = {
+                'status': 500,
+                'message': f"Internal server error: {e}"
+            }
+        results.append({'url': url, **result})
+
+    return jsonify({
+        'status': 200,
+        'message': f"{sum(result['status'] == 200 for result in results)} URLs queued for processing",
+        'results': results
+    }), 200
 
 
 if __name__ == '__main__':
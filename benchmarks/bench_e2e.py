@@ -0,0 +1,236 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+BENCH_USER = 'bench-user'
+
+# Each page is a fixture template with a seeded block of generated prose
+# added, so no two pages share their content or their embeddings
+class FixtureSite:
+
+    def __init__(self, fixtures, words_per_page, seed=0):
+        self.templates = []
+        for path in sorted(glob.glob(os.path.join(fixtures, '*.html'))):
+            with open(path, encoding='utf-8') as f:
+                self.templates.append(f.read())
+        if not self.templates:
+            raise SystemExit(f"No .html fixtures found in {fixtures}")
+
+        text = re.sub(r"<[^>]+>", " ", " ".join(self.templates))
+        self.vocabulary = sorted({word.lower() for word in re.findall(r"[A-Za-z]{4,}", text)})
+        self.words_per_page = words_per_page
+        self.seed = seed
+
+    def page(self, n):
+        rng = random.Random(f"{self.seed}-{n}")
+        paragraphs = []
+        remaining = self.words_per_page
+        while remaining > 0:
+            size = min(remaining, rng.randint(40, 120))
+            paragraphs.append("<p>" + " ".join(rng.choice(self.vocabulary) for _ in range(size)).capitalize() + ".</p>")
+            remaining -= size
+
+        template = self.templates[n % len(self.templates)]
+        return template.replace("</body>", "\n".join(paragraphs) + "\n</body>", 1)
+
+    def phrase(self, rng, words=6):
+        return " ".join(rng.choice(self.vocabulary) for _ in range(words))
+
+
+def fixture_handler(site):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            match = re.fullmatch(r"/page/(\d+)", self.path)
+            if match is None:
+                self.send_error(404)
+                return
+
+            body = site.page(int(match.group(1))).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def fake_embedding(text, dim):
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).round(6).tolist()
+
+def embeddings_handler(latency):
+    # Speaks just enough of the OpenAI embeddings API for request_embeddings
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            inputs = request['input']
+            if isinstance(inputs, str):
+                inputs = [inputs]
+
+            if latency:
+                time.sleep(latency)
+
+            body = json.dumps({
+                'object': 'list',
+                'model': request['model'],
+                'data': [
+                    {'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, request['dimensions'])}
+                    for i, text in enumerate(inputs)
+                ]
+            }).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def setup_database(dsn, reset):
+    import psycopg2
+
+    # A plain connection: the pool registers the vector type, which needs the extension first
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            with open(os.path.join(BENCHMARKS, 'schema.sql'), encoding='utf-8') as f:
+                cursor.execute(f.read())
+            if reset:
+                cursor.execute("TRUNCATE chunks, pages, queue, requests, suggestions CASCADE")
+                # TRUNCATE skips the stats triggers, so their counters are zeroed by hand
+                cursor.execute("SELECT to_regclass('stats_counters')")
+                if cursor.fetchone()[0]:
+                    cursor.execute("UPDATE stats_counters SET value = 0")
+            cursor.execute("INSERT INTO users (id) VALUES (%s) ON CONFLICT DO NOTHING", (BENCH_USER,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def run(label, fn, calls, concurrency):
+    def timed_call(args):
+        start = time.perf_counter()
+        try:
+            ok = fn(*args).get('status') == 200
+        except Exception as e:
+            print(f"{label}: {e}")
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed_call, calls))
+    wall = time.perf_counter() - start
+
+    ms = [elapsed * 1000 for elapsed, _ in results]
+    failed = sum(1 for _, ok in results if not ok)
+    print(
+        f"{label:<16} {len(results):6d} {failed:6d} {len(results) / wall:9.1f}"
+        f" {percentile(ms, 50):9.1f} {percentile(ms, 95):9.1f} {percentile(ms, 99):9.1f}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion and search end to end against local stand-ins")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="Local Postgres with pgvector (default: BENCH_DATABASE_URL)")
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--words-per-page', type=int, default=1500)
+    parser.add_argument('--searches', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--embed-latency-ms', type=float, default=0.0,
+                        help="Delay added to every embeddings request, standing in for the API round trip")
+    parser.add_argument('--chunk-store', choices=['memory', 'fs'], default='memory')
+    parser.add_argument('--no-reset', action='store_true', help="Keep existing rows instead of truncating")
+    parser.add_argument('--fixtures', default=os.path.join(BENCHMARKS, 'fixtures'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.database_url:
+        raise SystemExit("Set BENCH_DATABASE_URL (or --database-url) to a scratch Postgres with pgvector")
+
+    site = FixtureSite(args.fixtures, args.words_per_page, args.seed)
+    site_url = serve(fixture_handler(site))
+    embeddings_url = serve(embeddings_handler(args.embed_latency_ms / 1000))
+
+    # Read at import time by the modules below, so they have to be set first
+    os.environ.update({
+        'DATABASE_URL': args.database_url,
+        'OPENAI_EMBEDDINGS_URL': f"{embeddings_url}/v1/embeddings",
+        'OPENAI_API_KEY': 'bench',
+        'CHUNK_STORE': args.chunk_store,
+        'FETCH_PER_HOST': str(max(args.concurrency, 4)),
+        'DB_POOL_MAX_SIZE': str(max(args.concurrency * 2, 10)),
+    })
+    if args.chunk_store == 'fs':
+        import tempfile
+        os.environ['CHUNK_STORE_PATH'] = tempfile.mkdtemp(prefix='cozybench-')
+
+    setup_database(args.database_url, reset=not args.no_reset)
+
+    from app import app
+    from processURL import process_url, ensure_ingest_schema
+    from getForPhrase import get_matches_for_phrase
+    from getForWords import get_matches_for_words
+    from getForURL import get_matches_for_url
+
+    ensure_ingest_schema()
+
+    rng = random.Random(args.seed)
+    urls = [f"{site_url}/page/{n}" for n in range(args.pages)]
+    phrases = [site.phrase(rng) for _ in range(args.searches)]
+    word_lists = [[site.phrase(rng, 1) for _ in range(3)] for _ in range(args.searches)]
+    # Fresh phrases for the route, so it doesn't ride on the embedding cache warmed above
+    route_phrases = [site.phrase(rng) for _ in range(args.searches)]
+
+    def route(phrase):
+        response = app.test_client().get('/get/phrase', query_string={'sentence': phrase, 'user_id': BENCH_USER})
+        return response.get_json()
+
+    print(f"{args.pages} pages, {args.searches} searches per path, concurrency {args.concurrency}\n")
+    print(f"{'path':<16} {'calls':>6} {'failed':>6} {'per sec':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+    run('process_url', process_url, [(url, BENCH_USER) for url in urls], args.concurrency)
+    run('phrase', get_matches_for_phrase, [(phrase, BENCH_USER) for phrase in phrases], args.concurrency)
+    run('words', get_matches_for_words, [(words, BENCH_USER) for words in word_lists], args.concurrency)
+    run('url', get_matches_for_url, [(rng.choice(urls), BENCH_USER) for _ in range(args.searches)], args.concurrency)
+    run('GET /get/phrase', route, [(phrase,) for phrase in route_phrases], args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
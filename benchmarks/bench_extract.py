@@ -0,0 +1,60 @@
+import os
+import sys
+import glob
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import BACKENDS
+from utilities import parse_html, parse_html_soup
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def time_parser(parse, documents, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for url, html in documents:
+            parse(html, url)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare HTML extraction paths on stored fixtures")
+    parser.add_argument('--fixtures', default=FIXTURES)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    documents = []
+    for path in sorted(glob.glob(os.path.join(args.fixtures, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            documents.append((f"https://example.com/{os.path.basename(path)[:-5]}", f.read()))
+
+    if not documents:
+        raise SystemExit(f"No .html fixtures found in {args.fixtures}")
+
+    size = sum(len(html) for _, html in documents) / 1024
+    print(f"{len(documents)} fixtures, {size:.0f} KiB, best of {args.repeat}\n")
+
+    paths = {'bs4 (current)': parse_html_soup}
+    for name in BACKENDS:
+        paths[f'single-pass {name}'] = lambda html, url, name=name: parse_html(html, url, name)
+
+    baseline = None
+    for name, parse in paths.items():
+        elapsed = time_parser(parse, documents, args.repeat)
+        baseline = baseline or elapsed
+        print(f"{name:<28} {elapsed * 1000:9.2f} ms   {baseline / elapsed:5.2f}x")
+
+    # The single-pass extractor must agree with the code it replaces
+    print()
+    for url, html in documents:
+        expected = parse_html_soup(html, url)
+        for name in BACKENDS:
+            if parse_html(html, url, name) != expected:
+                print(f"MISMATCH {name}: {url}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from server import get_connection, settings_prefix
+from schema import VECTOR_COLUMNS, VECTOR_STORAGES, list_vector_indexes
+from retrieval import knn_query
+
+KEY_COLUMNS = {
+    'chunks': 'content_id',
+    'pages': 'id',
+}
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def sample_queries(conn, table, n):
+    column, _ = VECTOR_COLUMNS[table]
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT {column} FROM {table} ORDER BY random() LIMIT %s", (n,))
+        queries = [row[0] for row in cursor.fetchall()]
+    conn.rollback()
+    return queries
+
+def search(conn, table, query, k, settings, storage='full', rerank=None):
+    sql, values, settings = knn_query(table, KEY_COLUMNS[table], query, k, settings, storage, rerank)
+    prefix, prefix_values = settings_prefix(settings)
+
+    with conn.cursor() as cursor:
+        start = time.perf_counter()
+        cursor.execute(prefix + sql, prefix_values + values)
+        keys = [row[0] for row in cursor.fetchall()]
+        elapsed = time.perf_counter() - start
+    conn.rollback()
+
+    return keys, elapsed
+
+def report(label, recalls, latencies):
+    ms = [latency * 1000 for latency in latencies]
+    recall = f"{sum(recalls) / len(recalls):8.3f}" if recalls else f"{'exact':>8}"
+    print(
+        f"{label:<22} {recall}"
+        f" {percentile(ms, 50):9.2f} {percentile(ms, 95):9.2f} {percentile(ms, 99):9.2f}"
+    )
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Measure ANN recall@k and latency against exact search")
+    parser.add_argument('table', choices=list(VECTOR_COLUMNS))
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--ef-search', type=int, nargs='*', default=[])
+    parser.add_argument('--probes', type=int, nargs='*', default=[])
+    parser.add_argument('--storage', choices=VECTOR_STORAGES, nargs='*', default=['full'],
+                        help="First-pass storage modes to compare; compact ones need their index built")
+    parser.add_argument('--rerank', type=int, help="Candidates per result for compact storage (default VECTOR_RERANK)")
+    args = parser.parse_args()
+
+    sweeps = [('default', {})]
+    sweeps += [(f"ef_search={ef}", {'hnsw.ef_search': ef}) for ef in args.ef_search]
+    sweeps += [(f"probes={probes}", {'ivfflat.probes': probes}) for probes in args.probes]
+
+    with get_connection() as conn:
+        queries = sample_queries(conn, args.table, args.queries)
+        if not queries:
+            raise SystemExit(f"{args.table} is empty")
+
+        # Index scans off forces the exact, sequential-scan answer
+        exact = [search(conn, args.table, query, args.k, {'enable_indexscan': 'off'}) for query in queries]
+
+        print(f"{len(queries)} queries on {args.table}, recall@{args.k}\n")
+        print(f"{'setting':<22} {'recall':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        report('exact', [], [elapsed for _, elapsed in exact])
+
+        for storage in args.storage:
+            for label, settings in sweeps:
+                recalls = []
+                latencies = []
+                for query, (truth, _) in zip(queries, exact):
+                    keys, elapsed = search(conn, args.table, query, args.k, settings, storage, args.rerank)
+                    recalls.append(len(set(keys) & set(truth)) / max(1, len(truth)))
+                    latencies.append(elapsed)
+                report(label if storage == 'full' else f"{storage} {label}", recalls, latencies)
+
+    print(f"\n{'index':<40} {'size':>10}")
+    for table, name, size, _ in list_vector_indexes():
+        if table == args.table:
+            print(f"{name:<40} {size:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import FilesystemStore, MemoryStore, write_chunks, read_chunk
+
+
+# Adds a fixed per-request delay in front of a local store, standing in for R2's round trip
+class SlowStore:
+
+    def __init__(self, store, latency):
+        self.store = store
+        self.latency = latency
+        self.requests = 0
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def put(self, key, data):
+        self.requests += 1
+        time.sleep(self.latency)
+        self.store.put(key, data)
+
+    def get(self, key):
+        self.requests += 1
+        time.sleep(self.latency)
+        return self.store.get(key)
+
+    def get_range(self, key, start, end):
+        self.requests += 1
+        time.sleep(self.latency)
+        return self.store.get_range(key, start, end)
+
+    def put_many(self, items):
+        futures = [self.store.executor.submit(self.put, key, data) for key, data in items]
+        for future in futures:
+            future.result()
+
+
+def make_pages(pages, chunks_per_page, chunk_bytes):
+    rng = random.Random(0)
+    alphabet = "abcdefghijklmnopqrstuvwxyz     "
+    return [
+        (f"https://example.com/page/{p}", [
+            "".join(rng.choice(alphabet) for _ in range(chunk_bytes))
+            for _ in range(chunks_per_page)
+        ])
+        for p in range(pages)
+    ]
+
+def run(label, store, pages, packed, sequential):
+    start = time.perf_counter()
+    ids = []
+    for url, chunks in pages:
+        if sequential:
+            for content in chunks:
+                ids.extend(write_chunks(store, [content], url, packed=False))
+        else:
+            ids.extend(write_chunks(store, chunks, url, packed=packed))
+    write_time = time.perf_counter() - start
+    writes = store.requests
+
+    start = time.perf_counter()
+    for content_id in ids:
+        read_chunk(store, content_id)
+    read_time = time.perf_counter() - start
+
+    print(f"{label:<26} {write_time * 1000:10.1f} {writes:9d} {read_time * 1000:10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chunk upload strategies against a local store")
+    parser.add_argument('--backend', choices=['memory', 'fs'], default='memory')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--chunks', type=int, default=30)
+    parser.add_argument('--chunk-bytes', type=int, default=4000)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    pages = make_pages(args.pages, args.chunks, args.chunk_bytes)
+    print(f"{args.pages} pages x {args.chunks} chunks, {args.latency_ms} ms per request\n")
+    print(f"{'strategy':<26} {'write ms':>10} {'requests':>9} {'read ms':>10}")
+
+    def store():
+        if args.backend == 'fs':
+            local = FilesystemStore(tempfile.mkdtemp(prefix='cozychunks-'), args.workers)
+        else:
+            local = MemoryStore(args.workers)
+        return SlowStore(local, args.latency_ms / 1000)
+
+    run('sequential (current)', store(), pages, packed=False, sequential=True)
+    run('concurrent', store(), pages, packed=False, sequential=False)
+    run('packed', store(), pages, packed=True, sequential=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+-- Base tables for a local benchmark database, inferred from the queries in
+-- the app. The job queue, stats counters and ANN indexes are added on top by
+-- jobqueue.ensure_queue_schema, stats.ensure_stats_schema and schema.py.
+
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS pages (
+    id UUID PRIMARY KEY,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    title TEXT,
+    url TEXT NOT NULL,
+    embedding vector(1024),
+    added_by TEXT,
+    date TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS pages_url_idx ON pages (url);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    page_id UUID NOT NULL REFERENCES pages (id) ON DELETE CASCADE,
+    content_id TEXT NOT NULL,
+    embedding vector(768)
+);
+CREATE INDEX IF NOT EXISTS chunks_page_id_idx ON chunks (page_id);
+
+CREATE TABLE IF NOT EXISTS queue (
+    url TEXT NOT NULL,
+    add_by TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS requests (
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    content TEXT,
+    type TEXT,
+    user_id TEXT
+);
+
+CREATE TABLE IF NOT EXISTS suggestions (
+    url TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,460 @@
+import os
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    def __init__(self, max_size : int = 1024, ttl : float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class PostgresEmbeddingStore:
+
+    def __init__(
+            self,
+            table : str = 'embedding_cache',
+            max_age : float = None,
+            max_rows : int = None,
+            prune_interval : float = 3600.0
+        ):
+
+        self.table = table
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.prune_interval = prune_interval
+        self._ready = False
+        self._pruned_at = time.monotonic()
+        self._prune_lock = threading.Lock()
+
+    def _ensure_table(self, conn):
+        if self._ready:
+            return
+
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                        key TEXT PRIMARY KEY,
+                        embedding vector NOT NULL,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    )"""
+            )
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_created_at_idx ON {self.table} (created_at)")
+        conn.commit()
+        self._ready = True
+
+    def get_many(self, keys):
+        from server import get_connection
+
+        with get_connection() as conn:
+            self._ensure_table(conn)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT key, embedding FROM {self.table} WHERE key = ANY(%s)",
+                    (list(keys),)
+                )
+                rows = cursor.fetchall()
+            conn.rollback()
+
+        return {key: [float(x) for x in embedding] for key, embedding in rows}
+
+    def put_many(self, items):
+        from psycopg2.extras import execute_values
+        from server import get_connection
+
+        with get_connection() as conn:
+            self._ensure_table(conn)
+            with conn.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    f"INSERT INTO {self.table} (key, embedding) VALUES %s ON CONFLICT (key) DO NOTHING",
+                    list(items.items()),
+                    template="(%s, %s::vector)"
+                )
+            conn.commit()
+
+            self._maybe_prune(conn)
+
+    def _maybe_prune(self, conn):
+        # At most once per prune_interval, by whichever writer gets here first
+        if self.max_age is None and self.max_rows is None:
+            return
+        if time.monotonic() - self._pruned_at < self.prune_interval or not self._prune_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._pruned_at = time.monotonic()
+            with conn.cursor() as cursor:
+                if self.max_age is not None:
+                    cursor.execute(
+                        f"DELETE FROM {self.table} WHERE created_at < NOW() - make_interval(secs => %s)",
+                        (self.max_age,)
+                    )
+                if self.max_rows is not None:
+                    cursor.execute(
+                        f"""
+                        DELETE FROM {self.table}
+                        WHERE created_at < (
+                            SELECT created_at FROM {self.table}
+                            ORDER BY created_at DESC
+                            OFFSET %s LIMIT 1
+                        )
+                        """,
+                        (self.max_rows,)
+                    )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error pruning the embedding cache store: {e}")
+        finally:
+            self._prune_lock.release()
+
+
+class DiskEmbeddingStore:
+
+    def __init__(self, path : str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get_many(self, keys):
+        keys = list(keys)
+        placeholders = ", ".join("?" for _ in keys)
+
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, embedding FROM embedding_cache WHERE key IN ({placeholders})",
+                keys
+            ).fetchall()
+
+        return {key: array.array('d', blob).tolist() for key, blob in rows}
+
+    def put_many(self, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embedding_cache (key, embedding) VALUES (?, ?)",
+                [(key, array.array('d', embedding).tobytes()) for key, embedding in items.items()]
+            )
+            self._conn.commit()
+
+
+class EmbeddingCache:
+
+    def __init__(self, max_size : int = 10000, ttl : float = None, store=None):
+        self.memory = LRUCache(max_size, ttl)
+        self.store = store
+
+        self.store_hits = 0
+        self.store_misses = 0
+        self.store_errors = 0
+
+    @staticmethod
+    def make_key(model : str, dim : int, text : str):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"{model}:{dim}:{digest}"
+
+    def get_many(self, model, dim, texts):
+        keys = {self.make_key(model, dim, text): text for text in texts}
+        found = {}
+
+        for key, text in keys.items():
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                found[text] = embedding.tolist()
+
+        missing = [key for key, text in keys.items() if text not in found]
+        if self.store is not None and missing:
+            try:
+                stored = self.store.get_many(missing)
+            except Exception as e:
+                print(f"Error reading from embedding cache store: {e}")
+                self.store_errors += 1
+                stored = {}
+
+            self.store_hits += len(stored)
+            self.store_misses += len(missing) - len(stored)
+
+            for key, embedding in stored.items():
+                self.memory.put(key, array.array('f', embedding))
+                found[keys[key]] = embedding
+
+        return found
+
+    def put_many(self, model, dim, embeddings):
+        items = {
+            self.make_key(model, dim, text): embedding
+            for text, embedding in embeddings.items()
+        }
+
+        # Held as float32 arrays, a quarter of the size of a list of floats
+        for key, embedding in items.items():
+            self.memory.put(key, array.array('f', embedding))
+
+        if self.store is not None and items:
+            try:
+                self.store.put_many(items)
+            except Exception as e:
+                print(f"Error writing to embedding cache store: {e}")
+                self.store_errors += 1
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update({
+            'store': type(self.store).__name__ if self.store is not None else None,
+            'store_hits': self.store_hits,
+            'store_misses': self.store_misses,
+            'store_errors': self.store_errors
+        })
+        return stats
+
+
+def make_embedding_store(kind, path=None):
+    if not kind:
+        return None
+    if kind == 'postgres':
+        max_rows = os.getenv('EMBEDDING_CACHE_STORE_MAX_ROWS')
+        return PostgresEmbeddingStore(
+            max_age=float(os.getenv('EMBEDDING_CACHE_STORE_TTL', 30 * 24 * 3600)),
+            max_rows=int(max_rows) if max_rows else None
+        )
+    if kind == 'disk':
+        return DiskEmbeddingStore(path or 'embedding_cache.sqlite3')
+
+    raise ValueError(f"Unknown embedding cache store: {kind}")
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    global _embedding_cache
+
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                ttl = os.getenv('EMBEDDING_CACHE_TTL')
+                _embedding_cache = EmbeddingCache(
+                    max_size=int(os.getenv('EMBEDDING_CACHE_SIZE', 10000)),
+                    ttl=float(ttl) if ttl else None,
+                    store=make_embedding_store(
+                        os.getenv('EMBEDDING_CACHE_STORE'),
+                        os.getenv('EMBEDDING_CACHE_PATH')
+                    )
+                )
+    return _embedding_cache
+
+def embedding_cache_stats():
+    if _embedding_cache is None:
+        return None
+    return _embedding_cache.stats()
+
+
+class CorpusGeneration:
+
+    # A counter row bumped in the same transaction as every committed page.
+    # Other processes' bumps are picked up within refresh_interval seconds,
+    # this process's own ones straight away.
+    NAME = 'corpus_generation'
+
+    def __init__(self, refresh_interval : float = 1.0):
+        self.refresh_interval = refresh_interval
+
+        self._value = None
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _ensure_table(self, cursor):
+        if self._ready:
+            return
+
+        from stats import STATS_SCHEMA
+        cursor.execute(STATS_SCHEMA[0])
+        self._ready = True
+
+    def current(self):
+        if self._value is not None and time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return self._value
+
+        from server import get_connection
+
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return self._value
+
+            try:
+                with get_connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT to_regclass('stats_counters') IS NOT NULL")
+                        value = 0
+                        if cursor.fetchone()[0]:
+                            cursor.execute("SELECT value FROM stats_counters WHERE name = %s", (self.NAME,))
+                            row = cursor.fetchone()
+                            value = row[0] if row else 0
+                    conn.rollback()
+                self._value = max(self._value or 0, value)
+            except Exception as e:
+                # Keep serving under the last known generation rather than failing searches
+                print(f"Error reading the corpus generation: {e}")
+                if self._value is None:
+                    self._value = 0
+
+            self._refreshed_at = time.monotonic()
+            return self._value
+
+    def bump(self, cursor):
+        # Joins the caller's transaction; pass the result to advance() once it commits
+        self._ensure_table(cursor)
+        cursor.execute(
+            """
+            INSERT INTO stats_counters (name, value) VALUES (%s, 1)
+            ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + 1
+            RETURNING value
+            """,
+            (self.NAME,)
+        )
+        return cursor.fetchone()[0]
+
+    def advance(self, value):
+        with self._lock:
+            self._value = max(self._value or 0, value)
+
+
+class ResultCache:
+
+    def __init__(self, max_size : int = 1000, ttl : float = 300.0, generation : CorpusGeneration = None):
+        self.memory = LRUCache(max_size, ttl)
+        self.generation = generation or CorpusGeneration()
+        self.stale = 0
+
+    @staticmethod
+    def make_key(endpoint, query, k):
+        return (endpoint, " ".join(query.split()).casefold(), k)
+
+    def lookup(self, endpoint, query, k):
+        # Returns the current generation with the cached value, or None on a miss.
+        # The generation is read before any computing, so a page committed
+        # mid-search leaves the stored entry already stale instead of hiding
+        # the page until the TTL.
+        generation = self.generation.current()
+
+        entry = self.memory.get(self.make_key(endpoint, query, k))
+        if entry is not None:
+            if entry[0] == generation:
+                return generation, entry[1]
+            self.stale += 1
+
+        return generation, None
+
+    def store(self, endpoint, query, k, generation, value):
+        self.memory.put(self.make_key(endpoint, query, k), (generation, value))
+
+    def get_or_compute(self, endpoint, query, k, compute):
+        generation, value = self.lookup(endpoint, query, k)
+        if value is None:
+            value = compute()
+            self.store(endpoint, query, k, generation, value)
+        return value
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update({
+            'stale': self.stale,
+            'generation': self.generation.current()
+        })
+        return stats
+
+
+_corpus_generation = None
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_corpus_generation():
+    global _corpus_generation
+
+    if _corpus_generation is None:
+        with _result_cache_lock:
+            if _corpus_generation is None:
+                _corpus_generation = CorpusGeneration(
+                    refresh_interval=float(os.getenv('RESULT_CACHE_REFRESH_INTERVAL', 1.0))
+                )
+    return _corpus_generation
+
+def get_result_cache():
+    global _result_cache
+
+    if _result_cache is None:
+        generation = get_corpus_generation()
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(
+                    max_size=int(os.getenv('RESULT_CACHE_SIZE', 1000)),
+                    ttl=float(os.getenv('RESULT_CACHE_TTL', 300)),
+                    generation=generation
+                )
+    return _result_cache
+
+def result_cache_stats():
+    if _result_cache is None:
+        return None
+    return _result_cache.stats()
@@ -0,0 +1,176 @@
+import os
+import re
+import hashlib
+import numpy as np
+from urllib.parse import urlsplit, urlunsplit, unquote_plus
+from collections import defaultdict
+from server import get_connection, get_data_from_db, transaction
+
+TRACKING_PARAMS = {
+    'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'twclid',
+    'mc_cid', 'mc_eid', '_ga', '_gl', 'ref_src', 'ref_url',
+}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Near-duplicates differ in at most DEDUP_MAX_DISTANCE (default 3) of the 64
+# SimHash bits. With four 16-bit bands, any pair within 3 bits shares at least
+# one band exactly, which is what lets the band indexes find them.
+BANDS = 4
+BAND_BITS = 64 // BANDS
+
+FINGERPRINT_SCHEMA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS page_fingerprints (
+        page_id UUID PRIMARY KEY REFERENCES pages (id) ON DELETE CASCADE,
+        simhash BIGINT NOT NULL,
+        {", ".join(f"band{i} INTEGER NOT NULL" for i in range(BANDS))}
+    )
+    """,
+    *[f"CREATE INDEX IF NOT EXISTS page_fingerprints_band{i}_idx ON page_fingerprints (band{i})" for i in range(BANDS)],
+]
+
+WORD = re.compile(r"\w+")
+BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+
+
+def canonicalize_url(url):
+    # One spelling per page: lower-case scheme and host, no default port,
+    # fragment or tracking parameters, sorted query, no trailing slash
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+
+    host = (parts.hostname or '').rstrip('.')
+    if ':' in host:
+        host = f"[{host}]"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        host = f"{parts.username}{':' + parts.password if parts.password else ''}@{host}"
+
+    # Parameters are kept exactly as written, bare keys included, and only
+    # reordered by key
+    params = []
+    for param in parts.query.split('&'):
+        key = unquote_plus(param.split('=', 1)[0]).lower()
+        if param and not key.startswith('utm_') and key not in TRACKING_PARAMS:
+            params.append((key, param))
+    query = "&".join(param for _, param in sorted(params, key=lambda item: item[0]))
+
+    return urlunsplit((scheme, host, parts.path.rstrip('/'), query, ''))
+
+def simhash(text, shingle=3, min_shingles=None):
+    # 64-bit SimHash over word shingles, or None when the text is too short for
+    # its fingerprint to mean anything
+    min_shingles = int(os.getenv('DEDUP_MIN_SHINGLES', 20)) if min_shingles is None else min_shingles
+    words = [word.lower() for word in WORD.findall(text)]
+    shingles = {" ".join(words[i:i + shingle]) for i in range(max(0, len(words) - shingle + 1))}
+    if len(shingles) < min_shingles:
+        return None
+
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingles],
+        dtype=np.uint64
+    )
+    bits = (hashes[:, None] >> BIT_SHIFTS) & np.uint64(1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(shingles)
+
+    return sum(1 << i for i in np.flatnonzero(votes > 0).tolist())
+
+def bands(fingerprint):
+    mask = (1 << BAND_BITS) - 1
+    return [(fingerprint >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+def to_signed(fingerprint):
+    # BIGINT is signed, so the top bit wraps around
+    return fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+
+def ensure_fingerprint_schema():
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            for statement in FINGERPRINT_SCHEMA:
+                cursor.execute(statement)
+        conn.commit()
+
+def find_duplicate(fingerprint, max_distance=None):
+    # URL of an already-ingested page within max_distance bits, if any
+    if fingerprint is None:
+        return None
+
+    max_distance = int(os.getenv('DEDUP_MAX_DISTANCE', 3)) if max_distance is None else max_distance
+
+    where = " OR ".join(f"f.band{i} = %s" for i in range(BANDS))
+    rows = get_data_from_db(
+        f"SELECT p.url, f.simhash FROM page_fingerprints AS f JOIN pages AS p ON p.id = f.page_id WHERE {where}",
+        tuple(bands(fingerprint))
+    )
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    for url, other in rows:
+        if bin((other & ((1 << 64) - 1)) ^ fingerprint).count('1') <= max_distance:
+            return url
+    return None
+
+def insert_fingerprint(cursor, page_id, fingerprint):
+    if fingerprint is None:
+        return
+
+    cursor.execute(
+        f"""
+        INSERT INTO page_fingerprints (page_id, simhash, {", ".join(f"band{i}" for i in range(BANDS))})
+        VALUES (%s, %s, {", ".join("%s" for _ in range(BANDS))})
+        ON CONFLICT (page_id) DO NOTHING
+        """,
+        (page_id, to_signed(fingerprint), *bands(fingerprint))
+    )
+
+def backfill_fingerprints(batch_size=100):
+    # Fingerprints pages ingested before deduplication existed, from their
+    # stored chunk text. Overlapping chunks repeat shingles, which a SimHash
+    # over the set of shingles doesn't count twice. Pages are walked by id, so
+    # ones too short to fingerprint are passed over rather than retried.
+    from storage import get_chunk_store
+    from snippets import fetch_chunk_texts
+
+    ensure_fingerprint_schema()
+    store = get_chunk_store()
+
+    last_id = None
+    fingerprinted = 0
+    while True:
+        rows = get_data_from_db(
+            """
+            SELECT p.id, c.content_id
+            FROM (
+                SELECT id FROM pages
+                WHERE (%s::uuid IS NULL OR id > %s::uuid)
+                  AND NOT EXISTS (SELECT 1 FROM page_fingerprints AS f WHERE f.page_id = pages.id)
+                ORDER BY id
+                LIMIT %s
+            ) AS p
+            LEFT JOIN chunks AS c ON c.page_id = p.id
+            ORDER BY p.id
+            """,
+            (last_id, last_id, batch_size)
+        )
+        if rows is None:
+            raise Exception("Error in retrieval")
+        if not rows:
+            return fingerprinted
+
+        content_ids = defaultdict(list)
+        for page_id, content_id in rows:
+            content_ids[page_id].extend([content_id] if content_id else [])
+        last_id = rows[-1][0]
+
+        texts = fetch_chunk_texts(store, [content_id for ids in content_ids.values() for content_id in ids])
+
+        with transaction() as cursor:
+            for page_id, ids in content_ids.items():
+                fingerprint = simhash("\n".join(texts[content_id] for content_id in ids if content_id in texts))
+                if fingerprint is not None:
+                    insert_fingerprint(cursor, page_id, fingerprint)
+                    fingerprinted += 1
+
+        print(f"{fingerprinted} pages fingerprinted")
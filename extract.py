@@ -0,0 +1,195 @@
+import os
+import json
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+ARTICLE_TITLE_CLASSES = {"post-title", "entry-title", "article-title", "blog-post-title"}
+SKIPPED_TAGS = {"script", "style", "template"}
+
+# Same precedence as get_comprehensive_title in utilities.py
+TITLE_PRECEDENCE = [
+    "title",
+    "og:title",
+    "twitter:title",
+    "schema",
+    "json-ld",
+    "h1",
+    "article",
+    "meta",
+    "h2",
+    "h3",
+]
+
+
+class _Capture:
+
+    def __init__(self, key, tag):
+        self.key = key
+        self.tag = tag
+        self.depth = 1
+        self.parts = []
+
+
+# Receives the parser's start/end/data events and gathers every title
+# candidate plus the visible text in the same pass
+class PageCollector:
+
+    def __init__(self):
+        self.candidates = {}
+        self.text = []
+        self.captures = []
+        self.skip_depth = 0
+
+    def _capture(self, key, tag):
+        if key not in self.candidates and all(c.key != key for c in self.captures):
+            self.captures.append(_Capture(key, tag))
+
+    def _candidate(self, key, value):
+        if key not in self.candidates and value:
+            self.candidates[key] = value
+
+    def start(self, tag, attrs):
+        tag = tag.lower()
+
+        for capture in self.captures:
+            if capture.tag == tag:
+                capture.depth += 1
+
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+            if tag == "script" and (attrs.get("type") or "").lower() == "application/ld+json":
+                self._capture("json-ld", tag)
+
+        elif tag == "meta":
+            content = attrs.get("content")
+            if attrs.get("property") == "og:title":
+                self._candidate("og:title", content)
+            if attrs.get("name") == "twitter:title":
+                self._candidate("twitter:title", content)
+            if attrs.get("itemprop") == "headline":
+                self._candidate("schema", content)
+            if attrs.get("name") == "title":
+                self._candidate("meta", content)
+
+        elif tag in ("title", "h1", "h2", "h3"):
+            self._capture(tag, tag)
+
+        classes = (attrs.get("class") or "").split()
+        if ARTICLE_TITLE_CLASSES.intersection(classes):
+            self._capture("article", tag)
+
+    def end(self, tag):
+        tag = tag.lower()
+
+        if tag in SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+
+        for capture in list(self.captures):
+            if capture.tag != tag:
+                continue
+            capture.depth -= 1
+            if capture.depth == 0:
+                self.captures.remove(capture)
+                self._finish(capture)
+
+    def _finish(self, capture):
+        text = "".join(capture.parts)
+
+        if capture.key == "json-ld":
+            try:
+                data = json.loads(text)
+            except json.JSONDecodeError:
+                data = None
+            value = None
+            if isinstance(data, dict):
+                value = data.get("headline") or data.get("name")
+            # Only the first ld+json block is considered, as before
+            self.candidates.setdefault("json-ld", value if isinstance(value, str) else None)
+        elif capture.key == "title":
+            self._candidate("title", text)
+        else:
+            self._candidate(capture.key, text.strip())
+
+    def data(self, data):
+        for capture in self.captures:
+            capture.parts.append(data)
+
+        if not self.skip_depth:
+            self.text.append(data)
+
+    def close(self):
+        # Unclosed elements at the end of the document still count
+        for capture in self.captures:
+            self._finish(capture)
+        self.captures = []
+
+        return self.candidates, "".join(self.text)
+
+
+class _StdlibParser(HTMLParser):
+
+    def __init__(self, collector):
+        super().__init__(convert_charrefs=True)
+        self.collector = collector
+
+    def handle_starttag(self, tag, attrs):
+        self.collector.start(tag, {key: value for key, value in attrs})
+
+    def handle_startendtag(self, tag, attrs):
+        self.collector.start(tag, {key: value for key, value in attrs})
+        self.collector.end(tag)
+
+    def handle_endtag(self, tag):
+        self.collector.end(tag)
+
+    def handle_data(self, data):
+        self.collector.data(data)
+
+
+def _parse_stdlib(html):
+    collector = PageCollector()
+    parser = _StdlibParser(collector)
+    parser.feed(html)
+    parser.close()
+    return collector.close()
+
+def _parse_lxml(html):
+    # lxml drives the collector directly through its parser-target interface,
+    # so no tree is ever built
+    collector = PageCollector()
+    parser = etree.HTMLParser(target=collector, encoding='utf-8')
+    return etree.fromstring(html.encode('utf-8'), parser) if html.strip() else collector.close()
+
+BACKENDS = {
+    "html.parser": _parse_stdlib,
+}
+if etree is not None:
+    BACKENDS["lxml"] = _parse_lxml
+
+def default_backend():
+    # Read per call, so HTML_PARSER from .env applies whenever it is loaded
+    return os.getenv("HTML_PARSER") or ("lxml" if etree is not None else "html.parser")
+
+def extract_html(html: str, backend: str = None):
+    backend = backend or default_backend()
+    parse = BACKENDS.get(backend)
+    if parse is None:
+        raise ValueError(f"Unknown or unavailable HTML parser backend: {backend}")
+
+    candidates, text = parse(html)
+
+    title = None
+    for key in TITLE_PRECEDENCE:
+        title = candidates.get(key)
+        if title:
+            break
+
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    body_text = '\n'.join(chunk for chunk in chunks if chunk)
+
+    return title, body_text
@@ -0,0 +1,172 @@
+import os
+import asyncio
+import threading
+import concurrent.futures
+from collections import namedtuple, Counter
+from urllib.parse import urlparse
+import aiohttp
+
+FetchResult = namedtuple('FetchResult', ['url', 'status', 'text', 'headers'])
+
+
+class FetchError(Exception):
+    pass
+
+
+def cache_validators(headers):
+    # ETag and Last-Modified of a response, for the next conditional request
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    return headers.get('etag'), headers.get('last-modified')
+
+def conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+class AsyncFetcher:
+
+    def __init__(
+            self,
+            max_connections : int = 100,
+            per_host : int = 4,
+            connect_timeout : float = 10.0,
+            read_timeout : float = 30.0,
+            total_timeout : float = 60.0,
+            max_bytes : int = 5 * 1024 * 1024,
+            user_agent : str = 'CozySearchBot/1.0'
+        ):
+
+        self.max_connections = max_connections
+        self.per_host = per_host
+        # A total deadline too, so a server trickling bytes just inside
+        # sock_read can't hold a caller indefinitely
+        self.total_timeout = total_timeout
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        self.max_bytes = max_bytes
+        self.headers = {
+            'User-Agent': user_agent,
+            'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+            'Accept-Encoding': 'gzip, deflate'
+        }
+        self._session = None
+
+    def _get_session(self):
+        # Sessions are bound to the loop they were created on, so build lazily inside it
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.per_host,
+                keepalive_timeout=30,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers=self.headers
+            )
+        return self._session
+
+    async def fetch(self, url, headers=None):
+        session = self._get_session()
+
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status >= 400:
+                    raise FetchError(f"{response.status} {response.reason} for url: {url}")
+
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    raise FetchError(f"Response of {response.content_length} bytes exceeds the limit")
+
+                body = bytearray()
+                async for block in response.content.iter_chunked(64 * 1024):
+                    body.extend(block)
+                    if len(body) > self.max_bytes:
+                        raise FetchError(f"Response exceeds the limit of {self.max_bytes} bytes")
+
+                encoding = response.charset or 'utf-8'
+                try:
+                    text = body.decode(encoding, errors='replace')
+                except LookupError:
+                    text = body.decode('utf-8', errors='replace')
+
+                return FetchResult(str(response.url), response.status, text, dict(response.headers))
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise FetchError(f"{type(e).__name__}: {e}") from e
+
+    async def fetch_many(self, urls, headers=None):
+        # All fetched at once on the loop, at most per_host at a time for any
+        # one host, so each request's deadline starts when it really starts.
+        # Failures come back as exceptions in place.
+        semaphores = {}
+
+        async def fetch_one(url):
+            host = urlparse(url).netloc.lower()
+            semaphore = semaphores.setdefault(host, asyncio.Semaphore(self.per_host))
+            async with semaphore:
+                return await self.fetch(url, headers)
+
+        return await asyncio.gather(*(fetch_one(url) for url in urls), return_exceptions=True)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+# One event loop in a background thread serves every caller, so threads share
+# a single connection pool instead of each holding its own socket open
+_loop = None
+_fetcher = None
+_lock = threading.Lock()
+
+def get_fetcher():
+    global _loop, _fetcher
+
+    if _fetcher is None:
+        with _lock:
+            if _fetcher is None:
+                _loop = asyncio.new_event_loop()
+                threading.Thread(target=_loop.run_forever, name='fetcher', daemon=True).start()
+
+                _fetcher = AsyncFetcher(
+                    max_connections=int(os.getenv('FETCH_MAX_CONNECTIONS', 100)),
+                    per_host=int(os.getenv('FETCH_PER_HOST', 4)),
+                    connect_timeout=float(os.getenv('FETCH_CONNECT_TIMEOUT', 10)),
+                    read_timeout=float(os.getenv('FETCH_READ_TIMEOUT', 30)),
+                    total_timeout=float(os.getenv('FETCH_TOTAL_TIMEOUT', 60)),
+                    max_bytes=int(os.getenv('FETCH_MAX_BYTES', 5 * 1024 * 1024))
+                )
+    return _fetcher
+
+def fetch_url(url, headers=None):
+    fetcher = get_fetcher()
+    future = asyncio.run_coroutine_threadsafe(fetcher.fetch(url, headers), _loop)
+
+    # aiohttp enforces the same deadline; this is the backstop for the caller's thread
+    try:
+        return future.result(timeout=fetcher.total_timeout + 1)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise FetchError(f"Timed out after {fetcher.total_timeout}s fetching url: {url}")
+
+def fetch_urls(urls, headers=None):
+    # One waiting thread for the whole batch instead of one per page
+    fetcher = get_fetcher()
+    future = asyncio.run_coroutine_threadsafe(fetcher.fetch_many(urls, headers), _loop)
+
+    # Pages for the busiest host go per_host at a time, each within the deadline
+    busiest = max(Counter(urlparse(url).netloc.lower() for url in urls).values(), default=0)
+    rounds = -(-busiest // fetcher.per_host)
+    try:
+        return future.result(timeout=rounds * fetcher.total_timeout + 1)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise FetchError(f"Timed out after {rounds * fetcher.total_timeout}s fetching {len(urls)} urls")
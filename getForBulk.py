@@ -0,0 +1,64 @@
+from analytics import log_request
+from utilities import embed_texts_openAI
+from schema import search_settings
+from retrieval import get_nearest_pages
+from snippets import attach_snippets
+from cache import get_result_cache
+
+def stream_matches_for_phrases(phrases, user_id, include_text=False):
+    # Yields one result per phrase as soon as it is ready, tagged with its index.
+    # Cached phrases come back first; the rest share one batched embedding
+    # call, then each is yielded as soon as its own lookup finishes.
+    cache = get_result_cache()
+    settings = search_settings('phrase')
+
+    pending = []
+    for index, phrase in enumerate(phrases):
+        generation, urls = cache.lookup('phrase', phrase, 20)
+        if urls is None:
+            pending.append((index, phrase, generation))
+        else:
+            log_request(phrase, "phrase", user_id)
+            yield result(index, phrase, urls, include_text)
+
+    if not pending:
+        return
+
+    try:
+        embeddings = embed_texts_openAI([phrase for _, phrase, _ in pending], 768)
+    except Exception as e:
+        print(f"Error embedding bulk phrases: {e}")
+        for index, phrase, _ in pending:
+            yield error(index, phrase)
+        return
+
+    # Each lookup checks a pooled connection out and back in before its result
+    # is yielded, so a slow reader never pins a connection
+    for (index, phrase, generation), embedding in zip(pending, embeddings):
+        try:
+            urls = get_nearest_pages(embedding, 20, settings)
+            cache.store('phrase', phrase, 20, generation, urls)
+            log_request(phrase, "phrase", user_id)
+
+        except Exception as e:
+            print(f"Error processing phrase: {e}")
+            yield error(index, phrase)
+            continue
+
+        yield result(index, phrase, urls, include_text)
+
+def result(index, phrase, urls, include_text):
+    return {
+        'index': index,
+        'sentence': phrase,
+        'status': 200,
+        'urls': attach_snippets([dict(url) for url in urls], phrase, include_text)
+    }
+
+def error(index, phrase):
+    return {
+        'index': index,
+        'sentence': phrase,
+        'status': 500,
+        'message': 'Internal Server Error'
+    }
@@ -1,21 +1,27 @@
-from server import get_data_from_db, talk_to_db
+from server import get_data_from_db
+from analytics import log_request
 from utilities import embed_text_openAI
+from schema import search_settings
+from retrieval import knn_query
+from cache import get_result_cache
+
+def search_pages(doc, k):
+    rows = get_data_from_db(*knn_query('pages', 'url', embed_text_openAI(doc, 1024), k, search_settings('document')))
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    return [row[0] for row in rows]
 
 def get_matches_for_doc(doc, user_id):
     try:
-        urls = get_data_from_db(
-            "SELECT url, embedding <=> %s::vector AS distance FROM pages ORDER BY distance LIMIT %s",
-            (embed_text_openAI(doc, 1024), 10)
-        )
+        urls = get_result_cache().get_or_compute('document', doc, 10, lambda: search_pages(doc, 10))
 
-        talk_to_db(
-            "INSERT INTO requests (created_at, content, type, user_id) VALUES (NOW(), %s, %s, %s)",
-            (doc, "document", user_id)
-        )
+        log_request(doc, "document", user_id)
 
         return {
             'status': 200,
-            'urls': [url[0] for url in urls]
+            'urls': urls
         }
 
     except Exception as e:
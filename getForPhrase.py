@@ -1,32 +1,24 @@
-from server import get_data_from_db, talk_to_db
-from utilities import embed_text_openAI, process_data
+from analytics import log_request
+from utilities import embed_text_openAI
+from schema import search_settings
+from retrieval import get_nearest_pages
+from snippets import attach_snippets
+from cache import get_result_cache
 
-def get_matches_for_phrase(phrase, user_id):
+def get_matches_for_phrase(phrase, user_id, include_text=False):
     try:
-        pageIDs = get_data_from_db(
-            "SELECT page_id, embedding <=> %s::vector AS distance FROM chunks ORDER BY distance LIMIT %s",
-            (embed_text_openAI(phrase, 768), 20)
+        urls = get_result_cache().get_or_compute(
+            'phrase', phrase, 20,
+            lambda: get_nearest_pages(embed_text_openAI(phrase, 768), 20, search_settings('phrase'))
         )
+        # Cached results are shared, so snippets go on copies
+        urls = attach_snippets([dict(url) for url in urls], phrase, include_text)
 
-        if pageIDs is None:
-            raise Exception("Error in retrieval")
-    
-        urls = []
-
-        for ID in pageIDs:
-            urls.append(get_data_from_db(
-                "SELECT (url, title) FROM pages WHERE id=%s",
-                (ID[0],)
-            ))
-
-        talk_to_db(
-            "INSERT INTO requests (created_at, content, type, user_id) VALUES (NOW(), %s, %s, %s)",
-            (phrase, "phrase", user_id)
-        )
+        log_request(phrase, "phrase", user_id)
 
         return {
             'status': 200,
-            'urls': process_data(urls)
+            'urls': urls
         }
 
     except Exception as e:
@@ -1,43 +1,63 @@
-from server import get_data_from_db, talk_to_db, exists_in_table
+import os
+import threading
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from analytics import log_request
 from utilities import (
     get_content_from_url, 
-    process_data, 
     intersection_of_tuples, 
-    embed_text_openAI
+    embed_text_openAI,
+    embed_texts_openAI,
+    truncate_to_tokens,
+    MAX_TOKENS_PER_INPUT
 )
+from schema import search_settings
+from dedup import canonicalize_url
+from retrieval import get_nearest_page_ids, get_pages_by_ids, get_page_vectors
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=int(os.getenv('URL_SEARCH_WORKERS', 8)))
+    return _executor
 
 def get_matches_for_url(url, user_id):
     try:
-        if url.endswith('/'):
-            url = url[:-1]
-
-        title, content = get_content_from_url(url)
-        embeds = [embed_text_openAI(title, 768), embed_text_openAI(content, 768)]
-
-        results = []
-        for embedding in embeds:
-            retrieved_data = get_data_from_db(
-                "SELECT page_id, embedding <=> %s::vector AS distance FROM chunks ORDER BY distance LIMIT %s",
-                (embedding, 10)
-            )
-            results.append([point[0] for point in retrieved_data])
-    
-        urls = []
-        for ID in intersection_of_tuples(results):
-            urls.append(get_data_from_db(
-                "SELECT url FROM pages WHERE id=%s",
-                (ID,)
-            ))
-
-        if not exists_in_table('pages', {'url': f"{url}"}):
-            talk_to_db(
-                "INSERT INTO requests (created_at, content, type, user_id) VALUES (NOW(), %s, %s, %s)",
-                (url, "url", user_id)
-            )
+        url = canonicalize_url(url)
+
+        settings = search_settings('url')
+        executor = get_executor()
+        stored = get_page_vectors(url)
+
+        if stored is not None:
+            # Already ingested: search with the stored chunk centroid straight away
+            # while the title (usually a cache hit) is embedded
+            title, body_embedding = stored
+            body_search = executor.submit(copy_context().run, get_nearest_page_ids, body_embedding, 10, settings)
+            title_search = executor.submit(copy_context().run, get_nearest_page_ids, embed_text_openAI(title, 768), 10, settings)
+
+        else:
+            title, content = get_content_from_url(url)
+            embeds = embed_texts_openAI([title, truncate_to_tokens(content, MAX_TOKENS_PER_INPUT)], 768)
+            title_search, body_search = [
+                executor.submit(copy_context().run, get_nearest_page_ids, embedding, 10, settings)
+                for embedding in embeds
+            ]
+
+        urls = get_pages_by_ids(intersection_of_tuples([title_search.result(), body_search.result()]))
+
+        if stored is None:
+            log_request(url, "url", user_id)
 
         return {
             'status': 200,
-            'urls': process_data(urls)
+            'urls': urls
         }
 
     except Exception as e:
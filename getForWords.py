@@ -1,34 +1,21 @@
-from server import get_data_from_db, talk_to_db
-from utilities import embed_text_openAI, process_data, intersection_of_tuples
+from analytics import log_request
+from utilities import embed_texts_openAI
+from schema import search_settings
+from retrieval import rank_pages
+from snippets import attach_snippets
 
-def get_matches_for_words(words, user_id):
+def get_matches_for_words(words, user_id, fusion='rrf', include_text=False):
     try:
-        results = []
-        embedded_words = [embed_text_openAI(word, 768) for word in words]
+        embedded_words = embed_texts_openAI(words, 768)
 
-        for embedding in embedded_words:
-            retrieved_data = get_data_from_db(
-                "SELECT page_id, embedding <=> %s::vector AS distance FROM chunks ORDER BY distance LIMIT %s",
-                (embedding, 10)
-            )
-        
-            results.append([point[0] for point in retrieved_data])
-    
-        urls = []
-        for IDs in intersection_of_tuples(results):
-            urls.append(get_data_from_db(
-                "SELECT (url, title) FROM pages WHERE id=%s",
-                (IDs,)
-            ))
-    
-        talk_to_db(
-            "INSERT INTO requests (created_at, content, type, user_id) VALUES (NOW(), %s, %s, %s)",
-            (", ".join(words), "words", user_id)
-        )
+        urls = rank_pages(embedded_words, 10, fusion=fusion, settings=search_settings('words'))
+        urls = attach_snippets(urls, words, include_text)
+
+        log_request(", ".join(words), "words", user_id)
 
         return {
             'status': 200,
-            'urls': process_data(urls)
+            'urls': urls
         }
 
     except Exception as e:
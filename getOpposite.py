@@ -1,35 +1,25 @@
-from server import get_data_from_db, talk_to_db
-from utilities import embed_text_openAI, process_data
+from analytics import log_request
+from utilities import embed_text_openAI
+from schema import search_settings
+from retrieval import get_farthest_pages
+from snippets import attach_snippets
 
-def get_opposite(phrase, user_id):
+def get_opposite(phrase, user_id, rerank=None, include_text=False):
     try:
-        pageIDs = get_data_from_db(
-            """SELECT page_id, 1 - (embedding <=> %s::vector) AS neg_distance
-               FROM chunks
-               ORDER BY neg_distance ASC
-               LIMIT %s;""",
-            (embed_text_openAI(phrase, 768), 10)
+        urls = get_farthest_pages(
+            embed_text_openAI(phrase, 768),
+            10,
+            search_settings('opposite'),
+            rerank=rerank
         )
+        # The farthest chunks share no terms with the phrase, so nothing to mark
+        urls = attach_snippets(urls, include_text=include_text)
 
-        if pageIDs is None:
-            raise Exception("Error in retrieval")
-    
-        urls = []
-
-        for ID in pageIDs:
-            urls.append(get_data_from_db(
-                "SELECT (url, title) FROM pages WHERE id=%s",
-                (ID[0],)
-            ))
-
-        talk_to_db(
-            "INSERT INTO requests (created_at, content, type, user_id) VALUES (NOW(), %s, %s, %s)",
-            (phrase, "phrase", user_id)
-        )
+        log_request(phrase, "phrase", user_id)
 
         return {
             'status': 200,
-            'urls': process_data(urls)
+            'urls': urls
         }
 
     except Exception as e:
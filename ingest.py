@@ -0,0 +1,235 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestScheduler:
+
+    def __init__(
+            self,
+            handler=None,
+            workers : int = 4,
+            max_queued : int = 1000,
+            per_host : int = 1,
+            host_delay : float = 1.0,
+            max_jobs : int = 1000
+        ):
+
+        self.handler = handler
+        self.max_queued = max_queued
+        self.per_host = per_host
+        self.host_delay = host_delay
+        self.max_jobs = max_jobs
+
+        # Pending tasks grouped by host; hosts are served round-robin
+        self._hosts = OrderedDict()
+        self._active = {}
+        self._next_start = {}
+        self._queued = 0
+        self._running = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+
+        # Per-process only; nothing here is shared between server workers
+        self._jobs = OrderedDict()
+        self._completed = 0
+        self._failed = 0
+
+        self._workers = [
+            threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, urls, user_id, handler=None):
+        job_id = str(uuid.uuid4())
+        job = {
+            'job_id': job_id,
+            'user_id': user_id,
+            'created_at': time.time(),
+            'finished_at': None,
+            'remaining': len(urls),
+            'results': [
+                {'url': url, 'status': 'queued', 'message': None}
+                for url in urls
+            ]
+        }
+
+        with self._cond:
+            if self._shutdown:
+                raise QueueFull("Scheduler is shutting down")
+            if self._queued + len(urls) > self.max_queued:
+                raise QueueFull(
+                    f"{self._queued} URLs already queued, cannot accept {len(urls)} more"
+                )
+
+            for index, url in enumerate(urls):
+                host = urlparse(url).netloc.lower()
+                self._hosts.setdefault(host, deque()).append((job, index, url, handler or self.handler))
+            self._queued += len(urls)
+
+            self._jobs[job_id] = job
+            self._evict_jobs()
+            self._cond.notify_all()
+
+        return job_id
+
+    def _evict_jobs(self):
+        while len(self._jobs) > self.max_jobs:
+            for job_id, job in self._jobs.items():
+                if job['remaining'] == 0:
+                    del self._jobs[job_id]
+                    break
+            else:
+                return
+
+    def _next_task(self):
+        now = time.monotonic()
+        wait = None
+
+        for host, tasks in self._hosts.items():
+            if self._active.get(host, 0) >= self.per_host:
+                continue
+
+            ready_at = self._next_start.get(host, 0)
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+
+            task = tasks.popleft()
+            if tasks:
+                self._hosts.move_to_end(host)
+            else:
+                del self._hosts[host]
+
+            self._active[host] = self._active.get(host, 0) + 1
+            self._next_start[host] = now + self.host_delay
+            self._queued -= 1
+            self._running += 1
+            return host, task, None
+
+        return None, None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._shutdown and not self._hosts:
+                        return
+
+                    host, task, wait = self._next_task()
+                    if task is not None:
+                        break
+
+                    self._cond.wait(wait)
+
+            job, index, url, handler = task
+            job['results'][index]['status'] = 'running'
+
+            try:
+                result = handler(url, job['user_id'])
+            except Exception as e:
+                result = {
+                    'status': 500,
+                    'message': f"Internal server error: {e}"
+                }
+
+            with self._cond:
+                job['results'][index] = {
+                    'url': url,
+                    'status': result['status'],
+                    'message': result['message']
+                }
+                job['remaining'] -= 1
+                if job['remaining'] == 0:
+                    job['finished_at'] = time.time()
+
+                if result['status'] == 200:
+                    self._completed += 1
+                else:
+                    self._failed += 1
+
+                self._active[host] -= 1
+                if self._active[host] == 0:
+                    del self._active[host]
+                    # Hosts that have been idle past their delay need no bookkeeping
+                    if host not in self._hosts and self._next_start.get(host, 0) <= time.monotonic():
+                        self._next_start.pop(host, None)
+                self._running -= 1
+                self._cond.notify_all()
+
+    def job_status(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+
+            return {
+                'job_id': job_id,
+                'created_at': job['created_at'],
+                'finished_at': job['finished_at'],
+                'total': len(job['results']),
+                'remaining': job['remaining'],
+                'results': [dict(result) for result in job['results']]
+            }
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': len(self._workers),
+                'queued': self._queued,
+                'max_queued': self.max_queued,
+                'running': self._running,
+                'hosts_pending': len(self._hosts),
+                'completed': self._completed,
+                'failed': self._failed
+            }
+
+    def shutdown(self, wait : bool = True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                from processURL import process_url
+                from processURL import ensure_ingest_schema
+
+                try:
+                    ensure_ingest_schema()
+                except Exception as e:
+                    print(f"Error migrating the ingestion tables: {e}")
+
+                _scheduler = IngestScheduler(
+                    process_url,
+                    workers=int(os.getenv('INGEST_WORKERS', 4)),
+                    max_queued=int(os.getenv('INGEST_MAX_QUEUED', 1000)),
+                    per_host=int(os.getenv('INGEST_PER_HOST', 1)),
+                    host_delay=float(os.getenv('INGEST_HOST_DELAY', 1.0))
+                )
+    return _scheduler
+
+def scheduler_stats():
+    if _scheduler is None:
+        return None
+    return _scheduler.stats()
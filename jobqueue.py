@@ -0,0 +1,144 @@
+import os
+from server import get_connection
+
+# The queue table predates the job queue, so the lease columns are added in place
+QUEUE_SCHEMA = [
+    "ALTER TABLE queue ADD COLUMN IF NOT EXISTS id BIGSERIAL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS queue_id_idx ON queue (id)",
+    "ALTER TABLE queue ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending'",
+    "ALTER TABLE queue ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE queue ADD COLUMN IF NOT EXISTS locked_until TIMESTAMPTZ",
+    "ALTER TABLE queue ADD COLUMN IF NOT EXISTS locked_by TEXT",
+    "ALTER TABLE queue ADD COLUMN IF NOT EXISTS last_error TEXT",
+    "CREATE INDEX IF NOT EXISTS queue_claim_idx ON queue (created_at) WHERE status = 'pending'",
+]
+
+CLAIM_QUERY = """
+    UPDATE queue
+    SET locked_until = NOW() + make_interval(secs => %s),
+        locked_by = %s,
+        attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM queue
+        WHERE status = 'pending'
+          AND (locked_until IS NULL OR locked_until < NOW())
+        ORDER BY created_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, url, add_by, attempts
+"""
+
+# Read per call, so values from .env apply whenever it is loaded
+def lease_seconds():
+    return float(os.getenv('INGEST_LEASE_SECONDS', 900))
+
+def attempt_limit():
+    return int(os.getenv('INGEST_MAX_ATTEMPTS', 5))
+
+def retry_delay_seconds():
+    return float(os.getenv('INGEST_RETRY_DELAY_SECONDS', 60))
+
+def ensure_queue_schema():
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            for statement in QUEUE_SCHEMA:
+                cursor.execute(statement)
+        conn.commit()
+
+def enqueue(url, user_id, claimed_by=None, lease=None):
+    # A claimed job is leased to its creator straight away, so other workers
+    # only pick it up if the creator dies before finishing it
+    lease = lease_seconds() if lease is None else lease
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            if claimed_by is None:
+                cursor.execute(
+                    "INSERT INTO queue (url, add_by, created_at) VALUES (%s, %s, NOW()) RETURNING id",
+                    (url, user_id)
+                )
+            else:
+                cursor.execute(
+                    """
+                    INSERT INTO queue (url, add_by, created_at, locked_until, locked_by, attempts)
+                    VALUES (%s, %s, NOW(), NOW() + make_interval(secs => %s), %s, 1)
+                    RETURNING id
+                    """,
+                    (url, user_id, lease, claimed_by)
+                )
+            job_id = cursor.fetchone()[0]
+        conn.commit()
+
+    return job_id
+
+def claim_jobs(worker_id, limit, lease=None):
+    lease = lease_seconds() if lease is None else lease
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(CLAIM_QUERY, (lease, worker_id, limit))
+            jobs = cursor.fetchall()
+        conn.commit()
+
+    return jobs
+
+def start_job(job_id, worker_id, lease=None):
+    # Restarts the lease when the job actually begins, since it may have sat in
+    # a local backlog since it was claimed. False when another worker holds it.
+    lease = lease_seconds() if lease is None else lease
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                UPDATE queue
+                SET locked_until = NOW() + make_interval(secs => %s)
+                WHERE id = %s AND locked_by = %s AND status = 'pending'
+                """,
+                (lease, job_id, worker_id)
+            )
+            started = cursor.rowcount == 1
+        conn.commit()
+
+    return started
+
+def complete_job(job_id, worker_id, cursor=None):
+    # Given a cursor, the delete joins the caller's transaction. False when the
+    # lease was lost to another worker, so the caller can roll back its writes.
+    if cursor is not None:
+        cursor.execute("DELETE FROM queue WHERE id = %s AND locked_by = %s", (job_id, worker_id))
+        return cursor.rowcount == 1
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM queue WHERE id = %s AND locked_by = %s", (job_id, worker_id))
+            completed = cursor.rowcount == 1
+        conn.commit()
+
+    return completed
+
+def fail_job(job_id, worker_id, error, attempts, max_attempts=None, retry_delay=None):
+    max_attempts = attempt_limit() if max_attempts is None else max_attempts
+    retry_delay = retry_delay_seconds() if retry_delay is None else retry_delay
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            if attempts >= max_attempts:
+                cursor.execute(
+                    """
+                    UPDATE queue
+                    SET status = 'failed', locked_until = NULL, locked_by = NULL, last_error = %s
+                    WHERE id = %s AND locked_by = %s
+                    """,
+                    (error, job_id, worker_id)
+                )
+            else:
+                # Back off by holding the lease a little longer instead of releasing it
+                cursor.execute(
+                    """
+                    UPDATE queue
+                    SET locked_until = NOW() + make_interval(secs => %s), locked_by = NULL, last_error = %s
+                    WHERE id = %s AND locked_by = %s
+                    """,
+                    (retry_delay * (2 ** (attempts - 1)), error, job_id, worker_id)
+                )
+        conn.commit()
@@ -0,0 +1,130 @@
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+
+    def __init__(self, name : str, help : str, label : str, buckets : tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+
+        # label value -> (per-bucket counts, sum, count)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+
+        for label_value, (counts, total, count) in sorted(series.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+
+        return "\n".join(lines)
+
+
+class Profile:
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        with self._lock:
+            total, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (total + elapsed, calls + 1)
+
+    def summary(self):
+        with self._lock:
+            stages = dict(self.stages)
+
+        return {
+            'total_ms': round((time.perf_counter() - self.started_at) * 1000, 2),
+            'stages': {
+                name: {'ms': round(total * 1000, 2), 'calls': calls}
+                for name, (total, calls) in stages.items()
+            }
+        }
+
+    def server_timing(self):
+        summary = self.summary()
+        entries = [f"{name};dur={stage['ms']}" for name, stage in summary['stages'].items()]
+        entries.append(f"total;dur={summary['total_ms']}")
+        return ", ".join(entries)
+
+
+STAGE_SECONDS = Histogram(
+    'cozysearch_stage_seconds',
+    "Time spent in each stage of search and ingestion",
+    'stage'
+)
+REQUEST_SECONDS = Histogram(
+    'cozysearch_request_seconds',
+    "End-to-end request latency by route",
+    'route'
+)
+HISTOGRAMS = [STAGE_SECONDS, REQUEST_SECONDS]
+
+# The profile of the request being served, if it asked for one. Work handed to
+# a thread pool only shows up in it when submitted through copy_context().run.
+_profile = ContextVar('profile', default=None)
+
+def start_profile(enabled=True):
+    # Always sets the variable, so a worker thread never carries over the last request's profile
+    profile = Profile() if enabled else None
+    _profile.set(profile)
+    return profile
+
+def resume_profile(profile):
+    # For work that runs after the view returned, like a streamed response body
+    _profile.set(profile)
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+
+        profile = _profile.get()
+        if profile is not None:
+            profile.add(name, elapsed)
+
+def observe_request(route, elapsed):
+    REQUEST_SECONDS.observe(elapsed, route)
+
+def render_metrics():
+    return "\n".join(histogram.render() for histogram in HISTOGRAMS) + "\n"
@@ -1,82 +1,192 @@
 import os
 import uuid
-import hashlib
-from datetime import datetime
+import socket
 from dotenv import load_dotenv
-from server import talk_to_db, exists_in_table
+from psycopg2.extras import execute_values
+from server import talk_to_db, exists_in_table, transaction, get_connection
 from utilities import ( 
-    get_content_from_url, 
+    fetch_page, 
     tokenize_and_embed_text, 
     embed_text_openAI, 
 )
-from r2 import upload_to_bucket, config_client
+from fetcher import cache_validators
+from storage import get_chunk_store, write_chunks, chunk_hash
+from jobqueue import enqueue, start_job, complete_job, fail_job, ensure_queue_schema
+from cache import get_corpus_generation
+from dedup import canonicalize_url, simhash, find_duplicate, insert_fingerprint, ensure_fingerprint_schema
 
 load_dotenv()
 
-client = config_client(
-    os.getenv('R2_ACCOUNT_ID'), 
-    os.getenv('R2_ACCESS_KEY_ID'), 
-    os.getenv('R2_SECRET_ACCESS_KEY')
-)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+CHUNK_SIZE = 1200
+CHUNK_OVERLAP = 0.25
 
-def process_url(url, user_id):
-    try:
-        if exists_in_table('pages', {'url': f"{url}"}):
-            return {
-                'status': 300,
-                'message': "This URL already exists in the DB"
-            }
-        
-        if not exists_in_table('users', {'id': f"{user_id}"}):
-            talk_to_db(
-                "INSERT INTO suggestions (url, created_at) VALUES (%s, NOW())",
-                (url,)
-            )
-            return {
-                'status': 401,
-                'message': f"User: {user_id} is unauthorized"
-            }
-        
+# Cache validators, chunk hashes and the mode a page was chunked in, kept so
+# pages can be re-crawled incrementally
+PAGE_SCHEMA = [
+    "ALTER TABLE pages ADD COLUMN IF NOT EXISTS etag TEXT",
+    "ALTER TABLE pages ADD COLUMN IF NOT EXISTS chunk_mode TEXT",
+    "ALTER TABLE pages ADD COLUMN IF NOT EXISTS last_modified TEXT",
+    "ALTER TABLE pages ADD COLUMN IF NOT EXISTS last_crawled_at TIMESTAMPTZ",
+    "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS chunk_hash TEXT",
+    "CREATE INDEX IF NOT EXISTS pages_crawl_due_idx ON pages ((COALESCE(last_crawled_at, created_at)))",
+]
+
+def chunk_mode():
+    # 'content' chunks survive edits elsewhere on the page, so re-crawls of
+    # pages chunked that way only re-embed what changed; opt in with CHUNK_MODE
+    return os.getenv('CHUNK_MODE', 'tokens')
+
+def pack_chunks():
+    return os.getenv('CHUNK_STORE_PACKED') == '1'
+
+def ensure_ingest_schema():
+    ensure_queue_schema()
+    ensure_fingerprint_schema()
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            for statement in PAGE_SCHEMA:
+                cursor.execute(statement)
+        conn.commit()
+
+def enqueue_url(url, user_id, claim=False):
+    if exists_in_table('pages', {'url': f"{url}"}):
+        return {
+            'status': 300,
+            'message': "This URL already exists in the DB"
+        }
+    
+    if not exists_in_table('users', {'id': f"{user_id}"}):
         talk_to_db(
-            "INSERT INTO queue (url, add_by, created_at) VALUES (%s, %s, NOW())",
-            (url, user_id)
+            "INSERT INTO suggestions (url, created_at) VALUES (%s, NOW())",
+            (url,)
         )
+        return {
+            'status': 401,
+            'message': f"User: {user_id} is unauthorized"
+        }
 
-        title, content = get_content_from_url(url)
-        chunksList = tokenize_and_embed_text(content, 1200, 0.25, 768)
-        page_id = str(uuid.uuid4())
+    job_id = enqueue(url, user_id, claimed_by=WORKER_ID if claim else None)
 
-        talk_to_db(
+    return {
+        'status': 200,
+        'message': "URL queued for processing",
+        'job_id': job_id
+    }
+
+def ingest_url(url, user_id, job_id, page=None):
+    # Another job for the same URL may have finished while this one waited
+    if exists_in_table('pages', {'url': f"{url}"}):
+        complete_job(job_id, WORKER_ID)
+        return {
+            'status': 300,
+            'message': "This URL already exists in the DB"
+        }
+
+    # A page fetched ahead of time in a batch, or the error it failed with
+    if isinstance(page, Exception):
+        raise page
+    response, title, content = page if page is not None else fetch_page(url)
+    etag, last_modified = cache_validators(response.headers)
+
+    # Mirrors and reposts are caught here, before any embedding or upload is paid for
+    fingerprint = simhash(content)
+    duplicate = find_duplicate(fingerprint)
+    if duplicate is not None:
+        complete_job(job_id, WORKER_ID)
+        return {
+            'status': 300,
+            'message': f"This page is a near-duplicate of {duplicate}"
+        }
+
+    mode = chunk_mode()
+    chunksList = tokenize_and_embed_text(content, CHUNK_SIZE, CHUNK_OVERLAP, 768, mode=mode)
+    page_embedding = embed_text_openAI(content, 1024, use_cache=False)
+    page_id = str(uuid.uuid4())
+
+    # All chunks are uploaded concurrently (or as one packed object) before
+    # anything is written to the DB
+    content_ids = write_chunks(
+        get_chunk_store(),
+        [content for content, _ in chunksList],
+        url,
+        packed=pack_chunks()
+    )
+    chunk_rows = [
+        (page_id, content_id, embedding, chunk_hash(content))
+        for content_id, (content, embedding) in zip(content_ids, chunksList)
+    ]
+
+    # The page, its chunks and the queue row are written in one transaction,
+    # so a failure part-way leaves no half-ingested page behind
+    with transaction() as cursor:
+        cursor.execute(
             """
-            INSERT INTO pages (id, created_at, title, url, embedding, added_by, date)
-            VALUES (%s, NOW(), %s, %s, %s, %s, NOW());
+            INSERT INTO pages (id, created_at, title, url, embedding, added_by, date, etag, last_modified, last_crawled_at, chunk_mode)
+            VALUES (%s, NOW(), %s, %s, %s, %s, NOW(), %s, %s, NOW(), %s);
             """,
-            (page_id, title, url, embed_text_openAI(content, 1024), user_id)
+            (page_id, title, url, page_embedding, user_id, etag, last_modified, mode)
         )
 
-        for (content, embedding) in chunksList:
-            key = f"{content}-{datetime.timestamp(datetime.now())}-{url}"
-            key_encoded = key.encode('utf-8')
-            key_hash = hashlib.md5(key_encoded).hexdigest()
-            content = content.encode('utf-8')
-            upload_to_bucket(client, content, key_hash, 'cozychunks')
+        execute_values(
+            cursor,
+            "INSERT INTO chunks (page_id, content_id, embedding, chunk_hash) VALUES %s",
+            chunk_rows,
+            template="(%s, %s, %s::vector, %s)",
+            page_size=500
+        )
 
-            talk_to_db(
-                "INSERT INTO chunks (page_id, content_id, embedding) VALUES (%s, %s, %s)",
-                (page_id, key_hash, embedding)
-            )
+        insert_fingerprint(cursor, page_id, fingerprint)
 
-        talk_to_db(
-            "DELETE FROM queue WHERE url=%s",
-            (url,)
-        )
+        # A job whose lease ran out may already be running elsewhere; rolling
+        # back here keeps the page from being inserted twice
+        if not complete_job(job_id, WORKER_ID, cursor):
+            raise Exception(f"Lease on job {job_id} was lost to another worker")
+
+        # Last, so the counter row is locked only until the commit just below
+        generation = get_corpus_generation().bump(cursor)
+
+    # Cached search results from before this page are stale from now on
+    get_corpus_generation().advance(generation)
 
+    return {
+        'status': 200,
+        'message': "Successfully Embedded"
+    }
+
+def process_url(url, user_id):
+    try:
+        url = canonicalize_url(url)
+        queued = enqueue_url(url, user_id, claim=True)
+        if queued['status'] != 200:
+            return queued
+
+    except Exception as e:
         return {
-            'status': 200,
-            'message': "Successfully Embedded"
+            'status': 500,
+            'message': f"Internal server error: {e}"
         }
 
+    return run_job(queued['job_id'], 1, url, user_id)
+
+def run_job(job_id, attempts, url, user_id, page=None):
+    try:
+        if not start_job(job_id, WORKER_ID):
+            return {
+                'status': 300,
+                'message': f"Job {job_id} is held by another worker"
+            }
+
+        return ingest_url(url, user_id, job_id, page)
+
     except Exception as e:
+        # The queue row stays behind with its error, and is retried once its lease runs out
+        try:
+            fail_job(job_id, WORKER_ID, str(e), attempts)
+        except Exception as error:
+            print(f"Error recording failure of job {job_id}: {error}")
+
         return {
             'status': 500,
             'message': f"Internal server error: {e}"
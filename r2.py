@@ -3,7 +3,7 @@ from botocore.config import Config
 from botocore.exceptions import ClientError
 import json
 
-def config_client(account_id, access_key, access_secret):
+def config_client(account_id, access_key, access_secret, max_pool_connections=10):
 
     session = boto3.Session(
         aws_access_key_id=access_key,
@@ -14,6 +14,11 @@ def config_client(account_id, access_key, access_secret):
         region_name='auto',
         s3={
             'addressing_style': 'virtual'
+        },
+        max_pool_connections=max_pool_connections,
+        retries={
+            'max_attempts': 5,
+            'mode': 'adaptive'
         }
     )
 
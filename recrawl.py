@@ -0,0 +1,238 @@
+import os
+import time
+import signal
+import argparse
+from functools import partial
+from collections import defaultdict
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+from server import get_data_from_db, talk_to_db, transaction
+from utilities import fetch_page, chunk_text, embed_texts_openAI, embed_text_openAI
+from fetcher import cache_validators, conditional_headers
+from storage import get_chunk_store, write_chunks, chunk_hash
+from snippets import fetch_chunk_texts
+from cache import get_corpus_generation
+from dedup import simhash, insert_fingerprint
+from ingest import IngestScheduler
+from processURL import ensure_ingest_schema, pack_chunks, CHUNK_SIZE, CHUNK_OVERLAP
+
+DUE_PAGES_QUERY = """
+    SELECT id, url, added_by, etag, last_modified, chunk_mode
+    FROM pages
+    WHERE COALESCE(last_crawled_at, created_at) < NOW() - make_interval(secs => %s)
+    ORDER BY COALESCE(last_crawled_at, created_at)
+    LIMIT %s
+"""
+
+def due_pages(max_age, limit):
+    rows = get_data_from_db(DUE_PAGES_QUERY, (max_age, limit))
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    return rows
+
+def touch_page(page_id, etag=None, last_modified=None):
+    talk_to_db(
+        """
+        UPDATE pages
+        SET last_crawled_at = NOW(),
+            etag = COALESCE(%s, etag),
+            last_modified = COALESCE(%s, last_modified)
+        WHERE id = %s
+        """,
+        (etag, last_modified, page_id)
+    )
+
+def stored_chunks(page_id):
+    # content_id and hash of every chunk on the page, plus the hashes that had
+    # to be worked out from the stored text because the chunk predates them.
+    # That text is read around the snippet cache so a re-crawl doesn't flush it.
+    rows = get_data_from_db("SELECT content_id, chunk_hash FROM chunks WHERE page_id = %s", (page_id,))
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    texts = fetch_chunk_texts(get_chunk_store(), [content_id for content_id, digest in rows if digest is None])
+    computed = [(content_id, chunk_hash(texts[content_id])) for content_id, digest in rows if digest is None and content_id in texts]
+
+    hashes = dict(computed)
+    return [(content_id, digest or hashes.get(content_id)) for content_id, digest in rows], computed
+
+def store_chunk_hashes(cursor, page_id, hashes):
+    # Saved once, so later re-crawls of the page don't read its text again
+    if not hashes:
+        return
+
+    execute_values(
+        cursor,
+        """
+        UPDATE chunks SET chunk_hash = data.digest
+        FROM (VALUES %s) AS data (page_id, content_id, digest)
+        WHERE chunks.page_id = data.page_id AND chunks.content_id = data.content_id
+        """,
+        [(page_id, content_id, digest) for content_id, digest in hashes],
+        template="(%s::uuid, %s, %s)"
+    )
+
+def recrawl_page(page_id, etag, last_modified, mode, url, user_id):
+    try:
+        response, title, content = fetch_page(url, conditional_headers(etag, last_modified))
+    except Exception as e:
+        # Wait out a full interval before trying a broken page again
+        touch_page(page_id)
+        return {
+            'status': 500,
+            'message': f"Error fetching the URL: {e}"
+        }
+
+    new_etag, new_last_modified = cache_validators(response.headers)
+
+    if response.status == 304:
+        touch_page(page_id, new_etag, new_last_modified)
+        return {
+            'status': 200,
+            'message': "Not modified"
+        }
+
+    try:
+        return refresh_page(page_id, url, title, content, new_etag, new_last_modified, mode)
+    except Exception as e:
+        touch_page(page_id)
+        return {
+            'status': 500,
+            'message': f"Internal server error: {e}"
+        }
+
+def refresh_page(page_id, url, title, content, etag, last_modified, mode=None):
+    # Chunks whose text is unchanged keep their stored object and vector; only
+    # new ones are embedded and uploaded. The page is re-chunked the way it was
+    # first chunked, whatever CHUNK_MODE says now, or the hashes wouldn't
+    # line up; pages from before the mode was stored were chunked by tokens.
+    mode = mode or 'tokens'
+    chunks = chunk_text(content, CHUNK_SIZE, CHUNK_OVERLAP, mode=mode)
+    stored, computed = stored_chunks(page_id)
+
+    existing = defaultdict(list)
+    for content_id, digest in stored:
+        existing[digest].append(content_id)
+
+    added = []
+    for chunk in chunks:
+        digest = chunk_hash(chunk)
+        if existing.get(digest):
+            existing[digest].pop()
+        else:
+            added.append((chunk, digest))
+    removed = [content_id for content_ids in existing.values() for content_id in content_ids]
+
+    if not added and not removed:
+        if computed:
+            with transaction() as cursor:
+                store_chunk_hashes(cursor, page_id, computed)
+        touch_page(page_id, etag, last_modified)
+        return {
+            'status': 200,
+            'message': "Content unchanged"
+        }
+
+    embeddings = embed_texts_openAI([chunk for chunk, _ in added], 768, use_cache=False) if added else []
+    page_embedding = embed_text_openAI(content, 1024, use_cache=False)
+    content_ids = write_chunks(get_chunk_store(), [chunk for chunk, _ in added], url, packed=pack_chunks())
+
+    with transaction() as cursor:
+        cursor.execute(
+            """
+            UPDATE pages
+            SET title = %s, embedding = %s, etag = %s, last_modified = %s, last_crawled_at = NOW()
+            WHERE id = %s
+            """,
+            (title, page_embedding, etag, last_modified, page_id)
+        )
+
+        store_chunk_hashes(cursor, page_id, computed)
+
+        if removed:
+            cursor.execute(
+                "DELETE FROM chunks WHERE page_id = %s AND content_id = ANY(%s)",
+                (page_id, removed)
+            )
+
+        execute_values(
+            cursor,
+            "INSERT INTO chunks (page_id, content_id, embedding, chunk_hash) VALUES %s",
+            [
+                (page_id, content_id, embedding, digest)
+                for content_id, embedding, (_, digest) in zip(content_ids, embeddings, added)
+            ],
+            template="(%s, %s, %s::vector, %s)",
+            page_size=500
+        )
+
+        cursor.execute("DELETE FROM page_fingerprints WHERE page_id = %s", (page_id,))
+        insert_fingerprint(cursor, page_id, simhash(content))
+
+        generation = get_corpus_generation().bump(cursor)
+
+    get_corpus_generation().advance(generation)
+
+    return {
+        'status': 200,
+        'message': f"Re-embedded {len(added)} of {len(chunks)} chunks, removed {len(removed)}"
+    }
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Re-crawl stored pages with conditional requests")
+    parser.add_argument('--max-age', type=float, default=float(os.getenv('RECRAWL_MAX_AGE', 7 * 24 * 3600)),
+                        help="Seconds since a page was last crawled before it is due again")
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--loop', action='store_true', help="Keep polling for due pages instead of exiting")
+    parser.add_argument('--poll-interval', type=float, default=60.0)
+    args = parser.parse_args()
+
+    ensure_ingest_schema()
+
+    scheduler = IngestScheduler(
+        workers=int(os.getenv('INGEST_WORKERS', 4)),
+        max_queued=args.batch,
+        per_host=int(os.getenv('INGEST_PER_HOST', 1)),
+        host_delay=float(os.getenv('INGEST_HOST_DELAY', 1.0))
+    )
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        pages = due_pages(args.max_age, args.batch)
+
+        for page_id, url, user_id, etag, last_modified, mode in pages:
+            scheduler.submit([url], user_id, handler=partial(recrawl_page, page_id, etag, last_modified, mode))
+
+        # A batch drains before the next query, so in-flight pages are never picked twice
+        while not stopping:
+            stats = scheduler.stats()
+            if stats['queued'] == 0 and stats['running'] == 0:
+                break
+            time.sleep(1)
+
+        if pages:
+            stats = scheduler.stats()
+            print(f"Re-crawled {len(pages)} pages ({stats['completed']} ok, {stats['failed']} failed so far)")
+        elif not args.loop:
+            break
+        else:
+            time.sleep(args.poll_interval)
+
+    scheduler.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    main()
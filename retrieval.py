@@ -0,0 +1,259 @@
+import numpy as np
+from collections import Counter
+from server import get_data_from_db
+from utilities import process_data
+from schema import VECTOR_COLUMNS, first_pass_order, vector_storage, rerank_factor
+
+# Top-k chunks resolved to their pages in one round trip; pages are
+# ordered by their best chunk so the nearest page still comes first,
+# and that chunk's content_id comes along for snippets.
+NEAREST_PAGES_QUERY = """
+    SELECT p.url, p.title, COUNT(*) AS hits, (ARRAY_AGG(c.content_id ORDER BY c.distance))[1]
+    FROM ({chunks}) AS c
+    JOIN pages AS p ON p.id = c.page_id
+    GROUP BY p.id, p.url, p.title
+    ORDER BY MIN(c.distance)
+"""
+
+# Cosine distance to -q is 2 minus the distance to q, so the nearest neighbours
+# of the negated query are exactly the farthest chunks, and the ANN index can
+# serve them like any other k-NN search
+FARTHEST_PAGES_QUERY = NEAREST_PAGES_QUERY
+
+# Oversampled ANN candidates for -q, re-ranked by their exact distance to q
+FARTHEST_PAGES_RERANKED_QUERY = """
+    SELECT p.url, p.title, COUNT(*) AS hits, (ARRAY_AGG(c.content_id ORDER BY c.distance DESC))[1]
+    FROM (
+        SELECT page_id, content_id, embedding <=> %s::vector AS distance
+        FROM (
+            SELECT page_id, content_id, embedding
+            FROM chunks
+            ORDER BY {order}
+            LIMIT %s
+        ) AS candidates
+        ORDER BY distance DESC
+        LIMIT %s
+    ) AS c
+    JOIN pages AS p ON p.id = c.page_id
+    GROUP BY p.id, p.url, p.title
+    ORDER BY MAX(c.distance) DESC
+"""
+
+def widen_ef_search(settings, candidates):
+    # HNSW never returns more rows than ef_search, so widen it to the candidate pool
+    settings = dict(settings or {})
+    settings['hnsw.ef_search'] = max(int(settings.get('hnsw.ef_search', 40)), candidates)
+    return settings
+
+def knn_query(table, select, embedding, k, settings=None, storage=None, rerank=None):
+    # The k rows of table nearest to embedding, with their exact cosine distance.
+    # Compact storage scans its index for rerank * k candidates first and
+    # re-ranks them on the full-precision column.
+    column, _ = VECTOR_COLUMNS[table]
+    storage = storage or vector_storage(table)
+
+    if storage == 'full':
+        query = f"""
+            SELECT {select}, {column} <=> %s::vector AS distance
+            FROM {table}
+            ORDER BY distance
+            LIMIT %s
+        """
+        return query, (embedding, k), settings
+
+    candidates = k * (rerank or rerank_factor())
+    query = f"""
+        SELECT {select}, {column} <=> %s::vector AS distance
+        FROM (
+            SELECT {select}, {column}
+            FROM {table}
+            ORDER BY {first_pass_order(table, '%s::vector', storage)}
+            LIMIT %s
+        ) AS candidates
+        ORDER BY distance
+        LIMIT %s
+    """
+    return query, (embedding, embedding, candidates, k), widen_ef_search(settings, candidates)
+
+def get_nearest_pages(embedding, k, settings=None):
+    chunks, values, settings = knn_query('chunks', 'page_id, content_id', embedding, k, settings)
+    rows = get_data_from_db(NEAREST_PAGES_QUERY.format(chunks=chunks), values, settings)
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    return process_data(rows)
+
+def get_farthest_pages(embedding, k, settings=None, rerank=None):
+    negated = [-x for x in embedding]
+
+    if rerank:
+        candidates = k * rerank
+        rows = get_data_from_db(
+            FARTHEST_PAGES_RERANKED_QUERY.format(order=first_pass_order('chunks', '%s::vector', vector_storage('chunks'))),
+            (embedding, negated, candidates, k),
+            widen_ef_search(settings, candidates)
+        )
+    else:
+        chunks, values, settings = knn_query('chunks', 'page_id, content_id', negated, k, settings)
+        rows = get_data_from_db(FARTHEST_PAGES_QUERY.format(chunks=chunks), values, settings)
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    return process_data(rows)
+
+def get_nearest_page_ids(embedding, k, settings=None):
+    query, values, settings = knn_query('chunks', 'page_id', embedding, k, settings)
+    rows = get_data_from_db(query, values, settings)
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    return [row[0] for row in rows]
+
+def get_page_vectors(url):
+    # An ingested page's title plus the centroid of its chunk vectors, which
+    # stands in for a fresh embedding of the whole body
+    rows = get_data_from_db(
+        """
+        SELECT p.title, AVG(c.embedding)
+        FROM pages AS p
+        JOIN chunks AS c ON c.page_id = p.id
+        WHERE p.url = %s
+        GROUP BY p.id, p.title
+        LIMIT 1
+        """,
+        (url,)
+    )
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+    if not rows:
+        return None
+
+    title, centroid = rows[0]
+    return title, [float(x) for x in centroid]
+
+def get_pages_by_ids(page_ids):
+    if not page_ids:
+        return []
+
+    hits = Counter(page_ids)
+    rows = get_data_from_db(
+        "SELECT id, url, title FROM pages WHERE id IN %s",
+        (tuple(hits.keys()),)
+    )
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    # Keep the order the IDs were ranked in, not whatever order Postgres returns
+    by_id = {str(page_id): (url, title) for page_id, url, title in rows}
+    ordered = [
+        (*by_id[str(page_id)], count)
+        for page_id, count in hits.items()
+        if str(page_id) in by_id
+    ]
+
+    return process_data(ordered)
+
+FUSIONS = ('sum', 'min', 'rrf')
+
+def get_candidate_chunks(embeddings, k, settings=None):
+    # Every query vector gets its own index-served k-NN scan, all in one round trip
+    values = ", ".join("(%s::vector)" for _ in embeddings)
+
+    storage = vector_storage('chunks')
+    if storage == 'full':
+        candidates = """
+            SELECT page_id, content_id, embedding
+            FROM chunks
+            ORDER BY chunks.embedding <=> q.embedding
+            LIMIT %s
+        """
+        limits = (k,)
+    else:
+        candidates = f"""
+            SELECT page_id, content_id, embedding
+            FROM (
+                SELECT page_id, content_id, embedding
+                FROM chunks
+                ORDER BY {first_pass_order('chunks', 'q.embedding', storage)}
+                LIMIT %s
+            ) AS candidates
+            ORDER BY candidates.embedding <=> q.embedding
+            LIMIT %s
+        """
+        limits = (k * rerank_factor(), k)
+        settings = widen_ef_search(settings, limits[0])
+
+    rows = get_data_from_db(
+        f"""
+        WITH q (embedding) AS (VALUES {values})
+        SELECT DISTINCT ON (c.content_id) p.id, p.url, p.title, c.content_id, c.embedding
+        FROM q
+        CROSS JOIN LATERAL ({candidates}) AS c
+        JOIN pages AS p ON p.id = c.page_id
+        """,
+        (*embeddings, *limits),
+        settings
+    )
+
+    if rows is None:
+        raise Exception("Error in retrieval")
+
+    return rows
+
+def fuse_scores(page_scores, fusion, rrf_k=60):
+    # page_scores holds the best chunk similarity of each page (columns) for each query (rows)
+    if fusion == 'sum':
+        return page_scores.sum(axis=0)
+    if fusion == 'min':
+        return page_scores.min(axis=0)
+    if fusion == 'rrf':
+        ranks = (-page_scores).argsort(axis=1).argsort(axis=1) + 1
+        return (1.0 / (rrf_k + ranks)).sum(axis=0)
+
+    raise ValueError(f"Unknown fusion: {fusion}")
+
+def rank_pages(embeddings, k, fusion='rrf', limit=10, settings=None):
+    rows = get_candidate_chunks(embeddings, k, settings)
+    if not rows:
+        return []
+
+    pages = {}
+    page_index = np.empty(len(rows), dtype=np.intp)
+    for i, (page_id, url, title, _, _) in enumerate(rows):
+        page_index[i] = pages.setdefault(page_id, (len(pages), url, title))[0]
+
+    queries = np.asarray(embeddings, dtype=np.float32)
+    chunks = np.stack([np.asarray(row[4], dtype=np.float32) for row in rows])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    chunks /= np.linalg.norm(chunks, axis=1, keepdims=True)
+
+    similarities = queries @ chunks.T
+
+    page_scores = np.full((len(pages), len(queries)), -np.inf, dtype=np.float32)
+    np.maximum.at(page_scores, page_index, similarities.T)
+    scores = fuse_scores(page_scores.T, fusion)
+    hits = np.bincount(page_index, minlength=len(pages))
+
+    # Each page's best chunk is the one closest to any of the queries
+    chunk_scores = similarities.max(axis=0)
+    best_chunk = {}
+    for i, index in enumerate(page_index):
+        if index not in best_chunk or chunk_scores[i] > chunk_scores[best_chunk[index]]:
+            best_chunk[index] = i
+
+    by_index = {index: (url, title) for index, url, title in pages.values()}
+    return [
+        {
+            "url": by_index[index][0],
+            "title": by_index[index][1],
+            "count": int(hits[index]),
+            "score": float(scores[index]),
+            "content_id": rows[best_chunk[index]][3]
+        }
+        for index in np.argsort(-scores)[:limit]
+    ]
@@ -0,0 +1,331 @@
+import os
+import time
+import argparse
+import threading
+from dotenv import load_dotenv
+from server import get_connection, get_data_from_db
+from stats import ensure_stats_schema
+from dedup import backfill_fingerprints
+
+# Vector columns searched by the get* handlers, with their dimensions
+VECTOR_COLUMNS = {
+    'chunks': ('embedding', 768),
+    'pages': ('embedding', 1024),
+}
+
+INDEX_METHODS = ('hnsw', 'ivfflat')
+
+# How the first-pass ANN search reads the vectors: the full-precision column,
+# a half-precision copy of it, or a binary quantization computed in the index.
+# Compact modes re-rank their candidates on the full-precision column.
+VECTOR_STORAGES = ('full', 'halfvec', 'binary')
+
+def index_name(table, method, storage='full'):
+    if storage == 'full':
+        return f"{table}_embedding_{method}_idx"
+    return f"{table}_embedding_{storage}_{method}_idx"
+
+def half_column(table):
+    column, _ = VECTOR_COLUMNS[table]
+    return f"{column}_half"
+
+def index_target(table, storage):
+    # The indexed expression and its operator class for each storage mode
+    column, dim = VECTOR_COLUMNS[table]
+    if storage == 'halfvec':
+        return f"{half_column(table)} halfvec_cosine_ops"
+    if storage == 'binary':
+        return f"(binary_quantize({column})::bit({dim})) bit_hamming_ops"
+    return f"{column} vector_cosine_ops"
+
+def first_pass_order(table, operand, storage):
+    # ORDER BY expression matching index_target, so the planner can use that index
+    column, dim = VECTOR_COLUMNS[table]
+    if storage == 'halfvec':
+        return f"{half_column(table)} <=> ({operand})::halfvec({dim})"
+    if storage == 'binary':
+        return f"binary_quantize({column})::bit({dim}) <~> binary_quantize({operand})::bit({dim})"
+    return f"{column} <=> {operand}"
+
+def run_autocommit(statements):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with get_connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                try:
+                    for statement, values in statements:
+                        cursor.execute(statement, values)
+                finally:
+                    # Don't hand session-level settings back to the pool
+                    if not conn.closed:
+                        cursor.execute("RESET ALL")
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
+
+def count_rows(table):
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            count = cursor.fetchone()[0]
+        conn.rollback()
+    return count
+
+def default_lists(rows):
+    # pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) beyond that
+    if rows <= 1000000:
+        return max(1, rows // 1000)
+    return int(rows ** 0.5)
+
+def create_vector_index(
+        table : str,
+        method : str = 'hnsw',
+        m : int = 16,
+        ef_construction : int = 64,
+        lists : int = None,
+        maintenance_work_mem : str = None,
+        concurrently : bool = True,
+        storage : str = 'full'
+    ):
+
+    if table not in VECTOR_COLUMNS:
+        raise ValueError(f"No vector column known for table {table}")
+    if method not in INDEX_METHODS:
+        raise ValueError(f"Index method must be one of {', '.join(INDEX_METHODS)}")
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"Vector storage must be one of {', '.join(VECTOR_STORAGES)}")
+
+    if method == 'hnsw':
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    else:
+        options = f"lists = {int(lists or default_lists(count_rows(table)))}"
+
+    statements = []
+    if maintenance_work_mem:
+        statements.append(("SELECT set_config('maintenance_work_mem', %s, false)", (maintenance_work_mem,)))
+    statements.append((
+        f"""
+        CREATE INDEX {'CONCURRENTLY' if concurrently else ''} IF NOT EXISTS {index_name(table, method, storage)}
+        ON {table} USING {method} ({index_target(table, storage)})
+        WITH ({options})
+        """,
+        None
+    ))
+
+    run_autocommit(statements)
+
+def drop_vector_index(table, method, concurrently=True, storage='full'):
+    run_autocommit([(
+        f"DROP INDEX {'CONCURRENTLY' if concurrently else ''} IF EXISTS {index_name(table, method, storage)}",
+        None
+    )])
+
+def reindex_vector_index(table, method, storage='full'):
+    # Rebuilds a bloated or degraded index without blocking writes
+    run_autocommit([(f"REINDEX INDEX CONCURRENTLY {index_name(table, method, storage)}", None)])
+
+def backfill_half_vectors(table, batch_size=1000):
+    # Adds the halfvec column plus a trigger that fills it on every write, then
+    # converts the existing rows a batch per transaction so no lock is held long
+    column, dim = VECTOR_COLUMNS[table]
+    half = half_column(table)
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {half} halfvec({dim})")
+            cursor.execute(
+                f"""
+                CREATE OR REPLACE FUNCTION {table}_fill_{half}() RETURNS trigger LANGUAGE plpgsql AS $$
+                BEGIN
+                    NEW.{half} := NEW.{column}::halfvec({dim});
+                    RETURN NEW;
+                END $$
+                """
+            )
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_fill_{half} ON {table}")
+            cursor.execute(
+                f"""
+                CREATE TRIGGER {table}_fill_{half} BEFORE INSERT OR UPDATE OF {column} ON {table}
+                FOR EACH ROW EXECUTE FUNCTION {table}_fill_{half}()
+                """
+            )
+        conn.commit()
+
+        converted = 0
+        while True:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    UPDATE {table} SET {half} = {column}::halfvec({dim})
+                    WHERE ctid = ANY(ARRAY(
+                        SELECT ctid FROM {table}
+                        WHERE {half} IS NULL AND {column} IS NOT NULL
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    ))
+                    """,
+                    (batch_size,)
+                )
+                updated = cursor.rowcount
+            conn.commit()
+
+            if updated == 0:
+                return converted
+            converted += updated
+            print(f"{table}: {converted} rows converted")
+
+def list_vector_indexes():
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT tablename, indexname, pg_size_pretty(pg_relation_size(indexname::regclass)), indexdef
+                FROM pg_indexes
+                WHERE tablename = ANY(%s) AND (indexdef ILIKE '%%USING hnsw%%' OR indexdef ILIKE '%%USING ivfflat%%')
+                """,
+                (list(VECTOR_COLUMNS),)
+            )
+            rows = cursor.fetchall()
+        conn.rollback()
+    return rows
+
+def search_settings(endpoint):
+    # Per-endpoint recall knobs, e.g. HNSW_EF_SEARCH_PHRASE=100, falling back to
+    # HNSW_EF_SEARCH / IVFFLAT_PROBES for every endpoint
+    settings = {}
+
+    ef_search = os.getenv(f"HNSW_EF_SEARCH_{endpoint.upper()}", os.getenv('HNSW_EF_SEARCH'))
+    if ef_search:
+        settings['hnsw.ef_search'] = int(ef_search)
+
+    probes = os.getenv(f"IVFFLAT_PROBES_{endpoint.upper()}", os.getenv('IVFFLAT_PROBES'))
+    if probes:
+        settings['ivfflat.probes'] = int(probes)
+
+    return settings
+
+_half_columns = {}
+_half_columns_lock = threading.Lock()
+
+def has_half_column(table, recheck_after=60.0):
+    # Once found the column stays; a missing one is looked for again now and then
+    with _half_columns_lock:
+        exists, checked_at = _half_columns.get(table, (False, None))
+    if exists or (checked_at is not None and time.monotonic() - checked_at < recheck_after):
+        return exists
+
+    rows = get_data_from_db(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+        )
+        """,
+        (table, half_column(table))
+    )
+    exists = bool(rows and rows[0][0])
+    if not exists and checked_at is None:
+        print(f"{table}.{half_column(table)} is missing, searching {table} at full precision until it is backfilled")
+
+    with _half_columns_lock:
+        _half_columns[table] = (exists, time.monotonic())
+    return exists
+
+def vector_storage(table):
+    # Per table, e.g. VECTOR_STORAGE_CHUNKS=halfvec, falling back to VECTOR_STORAGE.
+    # halfvec needs the table's half column, so without it the table is read
+    # at full precision rather than failing every search.
+    name = f"VECTOR_STORAGE_{table.upper()}"
+    storage = os.getenv(name, os.getenv('VECTOR_STORAGE', 'full'))
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"{name} must be one of {', '.join(VECTOR_STORAGES)}")
+
+    if storage == 'halfvec' and not has_half_column(table):
+        return 'full'
+    return storage
+
+def rerank_factor():
+    # Candidates fetched per result by the compact first pass, before exact re-ranking
+    return int(os.getenv('VECTOR_RERANK', 4))
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Manage ANN indexes on the vector columns")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help="Create an index")
+    create.add_argument('table', choices=list(VECTOR_COLUMNS))
+    create.add_argument('--method', choices=INDEX_METHODS, default='hnsw')
+    create.add_argument('--m', type=int, default=16)
+    create.add_argument('--ef-construction', type=int, default=64)
+    create.add_argument('--lists', type=int)
+    create.add_argument('--maintenance-work-mem')
+    create.add_argument('--blocking', action='store_true', help="Build without CONCURRENTLY (faster, locks writes)")
+    create.add_argument('--storage', choices=VECTOR_STORAGES, default='full')
+
+    drop = commands.add_parser('drop', help="Drop an index")
+    drop.add_argument('table', choices=list(VECTOR_COLUMNS))
+    drop.add_argument('--method', choices=INDEX_METHODS, default='hnsw')
+    drop.add_argument('--storage', choices=VECTOR_STORAGES, default='full')
+
+    reindex = commands.add_parser('reindex', help="Rebuild an index")
+    reindex.add_argument('table', choices=list(VECTOR_COLUMNS))
+    reindex.add_argument('--method', choices=INDEX_METHODS, default='hnsw')
+    reindex.add_argument('--storage', choices=VECTOR_STORAGES, default='full')
+
+    backfill = commands.add_parser('backfill', help="Add and fill the halfvec copy of a vector column")
+    backfill.add_argument('table', choices=list(VECTOR_COLUMNS))
+    backfill.add_argument('--batch-size', type=int, default=1000)
+
+    commands.add_parser('list', help="List ANN indexes")
+
+    commands.add_parser('stats', help="Install the stats counter triggers and recount every table")
+
+    fingerprints = commands.add_parser('fingerprints', help="Fingerprint pages ingested before deduplication")
+    fingerprints.add_argument('--batch-size', type=int, default=100)
+
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        create_vector_index(
+            args.table,
+            args.method,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            lists=args.lists,
+            maintenance_work_mem=args.maintenance_work_mem,
+            concurrently=not args.blocking,
+            storage=args.storage
+        )
+        print(f"Created {index_name(args.table, args.method, args.storage)}")
+
+    elif args.command == 'drop':
+        drop_vector_index(args.table, args.method, storage=args.storage)
+        print(f"Dropped {index_name(args.table, args.method, args.storage)}")
+
+    elif args.command == 'reindex':
+        reindex_vector_index(args.table, args.method, storage=args.storage)
+        print(f"Rebuilt {index_name(args.table, args.method, args.storage)}")
+
+    elif args.command == 'backfill':
+        converted = backfill_half_vectors(args.table, args.batch_size)
+        print(f"Backfilled {converted} rows of {args.table}.{half_column(args.table)}")
+
+    elif args.command == 'stats':
+        ensure_stats_schema(recount=True)
+        print("Stats counters installed and recounted")
+
+    elif args.command == 'fingerprints':
+        fingerprinted = backfill_fingerprints(args.batch_size)
+        print(f"Fingerprinted {fingerprinted} pages")
+
+    else:
+        for table, name, size, definition in list_vector_indexes():
+            print(f"{table:<8} {name:<32} {size:>10}  {definition}")
+
+
+if __name__ == '__main__':
+    main()
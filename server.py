@@ -1,6 +1,229 @@
 import os
+import time
+import threading
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
 from pgvector.psycopg2 import register_vector
+from metrics import stage
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(
+            self,
+            dsn : str,
+            min_size : int = 1,
+            max_size : int = 10,
+            timeout : float = 30.0,
+            max_idle : float = 300.0
+        ):
+
+        assert (0 <= min_size <= max_size)
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        register_vector(conn)
+        return conn
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.max_idle:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def getconn(self):
+        start = time.monotonic()
+        waited = False
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, idle_since = None, None
+                    break
+
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"No connection available after {self.timeout}s ({self.max_size} in use)"
+                    )
+
+                waited = True
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._checkouts += 1
+            if waited:
+                elapsed = time.monotonic() - start
+                self._waits += 1
+                self._wait_time += elapsed
+                self._max_wait = max(self._max_wait, elapsed)
+
+        try:
+            if conn is not None and not self._is_healthy(conn, idle_since):
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+                with self._cond:
+                    self._discarded += 1
+                conn = None
+
+            if conn is None:
+                conn = self._connect()
+
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        with self._cond:
+            self._in_use -= 1
+
+        if conn.closed:
+            self._discard(conn)
+            return
+
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time,
+                'wait_time_avg': self._wait_time / self._waits if self._waits else 0.0,
+                'wait_time_max': self._max_wait,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    os.getenv('DATABASE_URL'),
+                    min_size=int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+                    max_idle=float(os.getenv('DB_POOL_MAX_IDLE', 300))
+                )
+    return _pool
+
+def get_connection():
+    return get_pool().connection()
+
+def pool_stats():
+    if _pool is None:
+        return None
+    return _pool.stats()
+
+@contextmanager
+def transaction():
+    # Everything written through the cursor commits together, or not at all
+    with stage('db'), get_connection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
 def talk_to_db(
         query : str,
@@ -8,45 +231,53 @@ def talk_to_db(
     ):
 
     try:
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
+        with stage('db'), get_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, values)
+            conn.commit()
 
-        cursor = conn.cursor()
+    except Exception as e:
+        print(f"Error performing the action: {e}")
 
-        register_vector(conn)
-        cursor.execute(query, values)
 
-        conn.commit()
-        cursor.close()
+def settings_prefix(settings):
+    # Transaction-local settings (e.g. hnsw.ef_search) sent in the same round trip as the query
+    if not settings:
+        return "", ()
 
-    except Exception as e:
-        print(f"Error performing the actionr: {e}")
+    calls = ", ".join("set_config(%s, %s, true)" for _ in settings)
+    values = tuple(str(item) for pair in settings.items() for item in pair)
+    return f"SELECT {calls}; ", values
 
-
-def get_data_from_db(query, values=None):
+def get_data_from_db(query, values=None, settings=None):
     try:
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-
-        with conn.cursor() as cursor:
-            cursor.execute(query, values)
-            results = cursor.fetchall()
+        with stage('db'), get_connection() as conn:
+            with conn.cursor() as cursor:
+                prefix, prefix_values = settings_prefix(settings)
+                if prefix:
+                    query = prefix + query
+                    values = prefix_values + tuple(values or ())
+                cursor.execute(query, values)
+                results = cursor.fetchall()
+            conn.rollback()
         return results
     except Exception as e:
         print(f"Error in retrieval: {e}")
-        return None  
+        return None
 
 def exists_in_table (table_name, conditions):
 
     try:
-        conn = psycopg2.connect(os.getenv('DATABASE_URL'))
-        
-        cursor = conn.cursor()
-        where_clause = " AND ".join([f"{key} = %s" for key in conditions.keys()])
-        query = f"SELECT EXISTS(SELECT 1 FROM {table_name} WHERE {where_clause});"
-        cursor.execute(query, tuple(conditions.values()))
-        result = cursor.fetchone()[0]
+        with stage('db'), get_connection() as conn:
+            with conn.cursor() as cursor:
+                where_clause = " AND ".join([f"{key} = %s" for key in conditions.keys()])
+                query = f"SELECT EXISTS(SELECT 1 FROM {table_name} WHERE {where_clause});"
+                cursor.execute(query, tuple(conditions.values()))
+                result = cursor.fetchone()[0]
+            conn.rollback()
 
         return result
 
     except Exception as error:
 
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,152 @@
+import os
+import re
+import html
+import threading
+from collections import defaultdict
+from cache import LRUCache
+from storage import get_chunk_store, parse_content_id
+
+TERM = re.compile(r"\w+")
+
+
+def fetch_chunk_texts(store, content_ids):
+    # Chunks packed into the same object are served by one covering range read,
+    # and every object is fetched in parallel on the store's executor
+    groups = defaultdict(list)
+    for content_id in dict.fromkeys(content_ids):
+        key, byte_range = parse_content_id(content_id)
+        groups[key].append((content_id, byte_range))
+
+    def fetch(key, entries):
+        if entries[0][1] is None:
+            return {entries[0][0]: store.get(key).decode('utf-8')}
+
+        start = min(byte_range[0] for _, byte_range in entries)
+        end = max(byte_range[1] for _, byte_range in entries)
+        data = store.get_range(key, start, end)
+        return {
+            content_id: data[byte_range[0] - start:byte_range[1] - start].decode('utf-8')
+            for content_id, byte_range in entries
+        }
+
+    futures = {key: store.executor.submit(fetch, key, entries) for key, entries in groups.items()}
+
+    texts = {}
+    for key, future in futures.items():
+        try:
+            texts.update(future.result())
+        except Exception as e:
+            # A missing chunk drops its snippet, not the whole search
+            print(f"Error reading chunk {key}: {e}")
+    return texts
+
+
+_chunk_cache = None
+_chunk_cache_lock = threading.Lock()
+
+def get_chunk_cache():
+    global _chunk_cache
+
+    if _chunk_cache is None:
+        with _chunk_cache_lock:
+            if _chunk_cache is None:
+                ttl = os.getenv('SNIPPET_CACHE_TTL')
+                _chunk_cache = LRUCache(
+                    max_size=int(os.getenv('SNIPPET_CACHE_SIZE', 5000)),
+                    ttl=float(ttl) if ttl else None
+                )
+    return _chunk_cache
+
+def snippet_cache_stats():
+    if _chunk_cache is None:
+        return None
+    return _chunk_cache.stats()
+
+def get_chunk_texts(content_ids):
+    cache = get_chunk_cache()
+
+    texts = {}
+    misses = []
+    for content_id in content_ids:
+        text = cache.get(content_id)
+        if text is None:
+            misses.append(content_id)
+        else:
+            texts[content_id] = text
+
+    if misses:
+        fetched = fetch_chunk_texts(get_chunk_store(), misses)
+        for content_id, text in fetched.items():
+            cache.put(content_id, text)
+        texts.update(fetched)
+
+    return texts
+
+def word_start(text, position):
+    while position > 0 and (text[position - 1].isalnum() or text[position - 1] == '_'):
+        position -= 1
+    return position
+
+def word_end(text, position):
+    match = TERM.match(text, position) if position > 0 and TERM.match(text, position - 1) else None
+    return match.end() if match else position
+
+def highlight(text, query=None, width=None):
+    # A window of the chunk around the first query term, HTML-escaped, with
+    # every query term wrapped in <mark>
+    width = int(os.getenv('SNIPPET_WIDTH', 240)) if width is None else width
+    if isinstance(query, str):
+        query = [query]
+    terms = {term.lower() for phrase in (query or []) for term in TERM.findall(phrase) if len(term) > 2}
+
+    matches = [m for m in TERM.finditer(text) if m.group().lower() in terms]
+
+    start = 0
+    if matches:
+        start = max(0, matches[0].start() - width // 4)
+        # Don't open the window mid-word
+        if start > 0:
+            space = text.find(' ', start)
+            if space != -1 and space < matches[0].start():
+                start = space + 1
+            else:
+                start = word_start(text, start)
+    end = min(len(text), start + width)
+    if matches:
+        end = max(end, matches[0].end())
+    # Nor close it mid-word, which would also cut off a term on the edge
+    end = word_end(text, end)
+
+    parts = []
+    position = start
+    for match in matches:
+        if match.start() < start:
+            continue
+        if match.end() > end:
+            break
+        parts.append(html.escape(text[position:match.start()]))
+        parts.append(f"<mark>{html.escape(match.group())}</mark>")
+        position = match.end()
+    parts.append(html.escape(text[position:end]))
+
+    snippet = "".join(parts).strip()
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(text):
+        snippet = snippet + "…"
+    return snippet
+
+def attach_snippets(results, query=None, include_text=False):
+    content_ids = [result.pop('content_id', None) for result in results]
+
+    if not include_text:
+        return results
+
+    texts = get_chunk_texts([content_id for content_id in content_ids if content_id])
+
+    for result, content_id in zip(results, content_ids):
+        text = texts.get(content_id)
+        result['text'] = text
+        result['snippet'] = highlight(text, query) if text is not None else None
+
+    return results
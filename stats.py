@@ -0,0 +1,249 @@
+import os
+import time
+import threading
+from functools import wraps
+from collections import deque
+from server import get_connection, get_data_from_db
+
+COUNTED_TABLES = ('pages', 'requests', 'queue')
+
+# Queue rows only count while they are still pending; failed jobs stay in the
+# table but not in the counter
+COUNTED_ROWS = {'queue': "status = 'pending'"}
+
+# Row counts kept up to date by statement-level triggers, so reading them is
+# a primary-key lookup instead of a COUNT(*) over the whole table
+STATS_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS stats_counters (name TEXT PRIMARY KEY, value BIGINT NOT NULL DEFAULT 0)",
+    """
+    CREATE OR REPLACE FUNCTION stats_count_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO stats_counters (name, value)
+        SELECT TG_TABLE_NAME, COUNT(*) FROM new_rows HAVING COUNT(*) > 0
+        ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION stats_count_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO stats_counters (name, value)
+        SELECT TG_TABLE_NAME, -COUNT(*) FROM old_rows HAVING COUNT(*) > 0
+        ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION stats_count_queue_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO stats_counters (name, value)
+        SELECT TG_TABLE_NAME, COUNT(*) FROM new_rows WHERE status = 'pending' HAVING COUNT(*) > 0
+        ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION stats_count_queue_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO stats_counters (name, value)
+        SELECT TG_TABLE_NAME, -COUNT(*) FROM old_rows WHERE status = 'pending' HAVING COUNT(*) > 0
+        ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value;
+        RETURN NULL;
+    END $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION stats_count_queue_update() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        INSERT INTO stats_counters (name, value)
+        SELECT TG_TABLE_NAME, delta FROM (
+            SELECT (SELECT COUNT(*) FROM new_rows WHERE status = 'pending')
+                 - (SELECT COUNT(*) FROM old_rows WHERE status = 'pending') AS delta
+        ) AS change
+        WHERE delta <> 0
+        ON CONFLICT (name) DO UPDATE SET value = stats_counters.value + EXCLUDED.value;
+        RETURN NULL;
+    END $$
+    """,
+    "CREATE INDEX IF NOT EXISTS pages_created_at_idx ON pages (created_at)",
+]
+
+def trigger_names():
+    names = [f"{table}_stats_{op}" for table in COUNTED_TABLES for op in ('insert', 'delete')]
+    return names + [f"{table}_stats_update" for table in COUNTED_ROWS]
+
+def trigger_statements(table):
+    prefix = f"stats_count_{table}" if table in COUNTED_ROWS else "stats_count"
+    statements = [
+        f"DROP TRIGGER IF EXISTS {table}_stats_insert ON {table}",
+        f"""
+        CREATE TRIGGER {table}_stats_insert AFTER INSERT ON {table}
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION {prefix}_insert()
+        """,
+        f"DROP TRIGGER IF EXISTS {table}_stats_delete ON {table}",
+        f"""
+        CREATE TRIGGER {table}_stats_delete AFTER DELETE ON {table}
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION {prefix}_delete()
+        """,
+    ]
+
+    if table in COUNTED_ROWS:
+        # Rows leave the count when their status changes, not only when deleted
+        statements += [
+            f"DROP TRIGGER IF EXISTS {table}_stats_update ON {table}",
+            f"""
+            CREATE TRIGGER {table}_stats_update AFTER UPDATE ON {table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {prefix}_update()
+            """,
+        ]
+    return statements
+
+def ensure_stats_schema(recount=False):
+    # Installs the triggers and seeds each counter with one COUNT(*). Writes
+    # are locked out while that happens so no row is counted twice or missed.
+    # Run from `python schema.py stats`, never from the request path.
+    from jobqueue import ensure_queue_schema
+
+    # The queue counter reads the status column the job queue adds
+    ensure_queue_schema()
+
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            names = trigger_names()
+            cursor.execute("SELECT COUNT(*) FROM pg_trigger WHERE tgname = ANY(%s)", (names,))
+            if cursor.fetchone()[0] == len(names) and not recount:
+                conn.rollback()
+                return
+
+            for statement in STATS_SCHEMA:
+                cursor.execute(statement)
+
+            for table in COUNTED_TABLES:
+                cursor.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+                for statement in trigger_statements(table):
+                    cursor.execute(statement)
+                cursor.execute(
+                    f"""
+                    INSERT INTO stats_counters (name, value)
+                    SELECT %s, COUNT(*) FROM {table} WHERE {COUNTED_ROWS.get(table, 'TRUE')}
+                    ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+                    """,
+                    (table,)
+                )
+        conn.commit()
+
+
+# What the snapshot can read: the counters only mean something once every
+# trigger is installed, and queue.status only exists after the queue migration
+SCHEMA_STATE_QUERY = """
+    SELECT
+        (SELECT COUNT(*) FROM pg_trigger WHERE tgname = ANY(%s)),
+        EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'queue' AND column_name = 'status'
+        )
+"""
+
+SNAPSHOT_QUERY = """
+    SELECT
+        {counters},
+        {queue_age},
+        (SELECT COUNT(*) FROM pages WHERE created_at > NOW() - make_interval(secs => %s))
+"""
+
+_latencies = {}
+_latencies_lock = threading.Lock()
+
+def record_latency(endpoint, seconds):
+    with _latencies_lock:
+        samples = _latencies.get(endpoint)
+        if samples is None:
+            samples = _latencies[endpoint] = deque(maxlen=int(os.getenv('STATS_LATENCY_WINDOW', 1000)))
+        samples.append(seconds)
+
+def timed(endpoint):
+    def decorator(route):
+        @wraps(route)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return route(*args, **kwargs)
+            finally:
+                record_latency(endpoint, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def latency_stats():
+    with _latencies_lock:
+        windows = {endpoint: sorted(samples) for endpoint, samples in _latencies.items()}
+
+    return {
+        endpoint: {
+            'count': len(samples),
+            'p50_ms': round(percentile(samples, 50) * 1000, 2),
+            'p95_ms': round(percentile(samples, 95) * 1000, 2)
+        }
+        for endpoint, samples in windows.items()
+        if samples
+    }
+
+
+_snapshot = None
+_snapshot_at = 0.0
+_snapshot_lock = threading.Lock()
+
+def take_snapshot():
+    names = trigger_names()
+    rows = get_data_from_db(SCHEMA_STATE_QUERY, (names,))
+    if rows is None:
+        raise Exception("Error reading stats")
+    installed, has_status = rows[0]
+    installed = installed == len(names)
+
+    rate_window = float(os.getenv('STATS_RATE_WINDOW', 3600))
+    rows = get_data_from_db(
+        SNAPSHOT_QUERY.format(
+            counters="(SELECT COALESCE(json_object_agg(name, value), '{}'::json) FROM stats_counters)" if installed else "NULL",
+            queue_age="(SELECT EXTRACT(EPOCH FROM NOW() - MIN(created_at)) FROM queue WHERE status = 'pending')" if has_status else "NULL"
+        ),
+        (rate_window,)
+    )
+    if rows is None:
+        raise Exception("Error reading stats")
+
+    counters, queue_age, recent_pages = rows[0]
+    counters = counters or {}
+    snapshot = {
+        'links_added': counters.get('pages', 0) if installed else None,
+        'searches': counters.get('requests', 0) if installed else None,
+        'links_in_queue': counters.get('queue', 0) if installed else None,
+        'oldest_queued_seconds': float(queue_age) if queue_age is not None else None,
+        'pages_per_minute': round(recent_pages * 60 / rate_window, 2)
+    }
+    if not installed:
+        snapshot['counters_missing'] = "Run `python schema.py stats` to install the stats counters"
+    return snapshot
+
+def get_stats(max_age=None):
+    # Served from a snapshot at most max_age seconds old; one caller refreshes
+    # it while the others wait for the result
+    global _snapshot, _snapshot_at
+
+    max_age = float(os.getenv('STATS_MAX_AGE', 10)) if max_age is None else max_age
+
+    with _snapshot_lock:
+        now = time.monotonic()
+        if _snapshot is None or now - _snapshot_at > max_age:
+            _snapshot = take_snapshot()
+            _snapshot_at = now
+
+        snapshot = dict(_snapshot)
+        snapshot['age_seconds'] = round(now - _snapshot_at, 2)
+
+    snapshot['search_latency'] = latency_stats()
+    return snapshot
@@ -0,0 +1,178 @@
+import os
+import time
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from r2 import config_client
+from metrics import stage
+
+
+class ChunkStore(ABC):
+
+    def __init__(self, workers : int = 16):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    @abstractmethod
+    def put(self, key, data):
+        pass
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    def get_range(self, key, start, end):
+        return self.get(key)[start:end]
+
+    def put_many(self, items):
+        # Any failed upload raises here, before the caller records the keys
+        futures = [self.executor.submit(self.put, key, data) for key, data in items]
+        for future in futures:
+            future.result()
+
+    def get_many(self, keys):
+        return list(self.executor.map(self.get, keys))
+
+
+class R2Store(ChunkStore):
+
+    def __init__(self, client, bucket, workers : int = 16):
+        super().__init__(workers)
+        self.client = client
+        self.bucket = bucket
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def get_range(self, key, start, end):
+        response = self.client.get_object(Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+
+class FilesystemStore(ChunkStore):
+
+    def __init__(self, root, workers : int = 4):
+        super().__init__(workers)
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key escapes the store root: {key}")
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def get_range(self, key, start, end):
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+class MemoryStore(ChunkStore):
+
+    def __init__(self, workers : int = 4):
+        super().__init__(workers)
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, data):
+        with self._lock:
+            self.objects[key] = bytes(data)
+
+    def get(self, key):
+        with self._lock:
+            return self.objects[key]
+
+
+def chunk_key(content, url):
+    key = f"{content}-{time.time()}-{url}"
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+def chunk_hash(content):
+    # Identifies a chunk by its text, so a re-crawl can tell which chunks changed
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def write_chunks(store, chunks, url, packed=False):
+    # Returns one content_id per chunk, in order. A packed page is a single
+    # object of concatenated chunks; each content_id carries its byte range
+    # ("<key>#<start>-<end>"), so the offset index lives in the chunks table.
+    encoded = [content.encode('utf-8') for content in chunks]
+
+    if not packed:
+        keys = [chunk_key(content, url) for content in chunks]
+        with stage('upload'):
+            store.put_many(zip(keys, encoded))
+        return keys
+
+    if not encoded:
+        return []
+
+    pack_key = f"packs/{hashlib.md5(f'{url}-{time.time()}'.encode('utf-8')).hexdigest()}"
+    content_ids = []
+    offset = 0
+    for data in encoded:
+        content_ids.append(f"{pack_key}#{offset}-{offset + len(data)}")
+        offset += len(data)
+
+    with stage('upload'):
+        store.put(pack_key, b"".join(encoded))
+    return content_ids
+
+def parse_content_id(content_id):
+    if '#' not in content_id:
+        return content_id, None
+
+    key, byte_range = content_id.rsplit('#', 1)
+    start, end = byte_range.split('-')
+    return key, (int(start), int(end))
+
+def read_chunk(store, content_id):
+    key, byte_range = parse_content_id(content_id)
+
+    if byte_range is None:
+        data = store.get(key)
+    else:
+        data = store.get_range(key, *byte_range)
+
+    return data.decode('utf-8')
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_chunk_store():
+    global _store
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                kind = os.getenv('CHUNK_STORE', 'r2')
+                workers = int(os.getenv('UPLOAD_WORKERS', 16))
+
+                if kind == 'r2':
+                    client = config_client(
+                        os.getenv('R2_ACCOUNT_ID'),
+                        os.getenv('R2_ACCESS_KEY_ID'),
+                        os.getenv('R2_SECRET_ACCESS_KEY'),
+                        max_pool_connections=workers
+                    )
+                    _store = R2Store(client, os.getenv('R2_BUCKET', 'cozychunks'), workers)
+                elif kind == 'fs':
+                    _store = FilesystemStore(os.getenv('CHUNK_STORE_PATH', 'chunks'), workers)
+                elif kind == 'memory':
+                    _store = MemoryStore(workers)
+                else:
+                    raise ValueError(f"Unknown chunk store: {kind}")
+    return _store
@@ -1,33 +1,33 @@
 import re
 import os
+import time
+import random
+import hashlib
 import requests
 import tiktoken
 from bs4 import BeautifulSoup
-from collections import Counter
+from collections import deque
+from functools import lru_cache
 from urllib.parse import urlparse
-
-def process_data(input_data):
-    flattened_data = [item[0] for sublist in input_data for item in sublist]
-
-    processed_data = []
-    for item in flattened_data:
-        url, title = item.strip('()').split(',', 1)
-        url = url.strip('"')
-        title = title.strip().strip('"')
-        processed_data.append((url, title))
-    
-    counter = Counter(processed_data)
-
-    result = [
-        {
-            "url": url,
-            "title": title,
-            "count": count
-        }
-        for (url, title), count in counter.items()
-    ]
-    
-    return result
+from cache import get_embedding_cache
+from fetcher import fetch_url, fetch_urls, FetchError
+from extract import extract_html
+from metrics import stage
+
+def process_data(rows):
+    with stage('serialize'):
+        results = []
+        for url, title, count, *content_id in rows:
+            result = {
+                "url": url,
+                "title": title,
+                "count": count
+            }
+            if content_id:
+                result["content_id"] = content_id[0]
+            results.append(result)
+
+    return results
 
 def intersection_of_tuples(tuples):
   
@@ -136,14 +136,8 @@ def clean_title(title):
     
     return title.strip()
 
-def get_content_from_url(url: str):
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  
-    except requests.RequestException as e:
-        raise ConnectionRefusedError(f"Error fetching the URL: {e}")
-
-    soup = BeautifulSoup(response.text, 'html.parser')
+def parse_html_soup(html: str, url: str = None):
+    soup = BeautifulSoup(html, 'html.parser')
     
     # Get comprehensive title
     title = get_comprehensive_title(soup, url)
@@ -159,58 +153,384 @@ def get_content_from_url(url: str):
 
     return title, body_text
 
-def embed_text_openAI (text: str, dim: int) :
-    
+def parse_html(html: str, url: str = None, backend: str = None):
+    title, body_text = extract_html(html, backend)
+
+    if not title and url:
+        title = extract_title_from_url(url)
+
+    if title:
+        title = clean_title(title)
+
+    return title, body_text
+
+def fetch_page(url: str, headers: dict = None):
+    # The response alongside its parsed title and body; a 304 has nothing to parse
+    try:
+        with stage('fetch'):
+            response = fetch_url(url, headers)
+    except FetchError as e:
+        raise ConnectionRefusedError(f"Error fetching the URL: {e}")
+
+    if response.status == 304:
+        return response, None, None
+
+    with stage('parse'):
+        title, content = parse_html(response.text, url)
+    return response, title, content
+
+def fetch_pages(urls: list):
+    # fetch_page for many URLs over one batch; a page that failed comes back
+    # as its exception, in place
+    try:
+        with stage('fetch'):
+            responses = fetch_urls(urls)
+    except FetchError as e:
+        responses = [e] * len(urls)
+
+    pages = []
+    for url, response in zip(urls, responses):
+        if isinstance(response, BaseException):
+            pages.append(ConnectionRefusedError(f"Error fetching the URL: {response}"))
+            continue
+
+        try:
+            with stage('parse'):
+                title, content = parse_html(response.text, url)
+            pages.append((response, title, content))
+        except Exception as e:
+            pages.append(e)
+
+    return pages
+
+def get_content_from_url(url: str):
+    _, title, content = fetch_page(url)
+    return title, content
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_URL = "https://api.openai.com/v1/embeddings"
+
+# Limits of the embeddings endpoint for text-embedding-3-*
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_INPUT = 8191
+MAX_TOKENS_PER_REQUEST = 300000
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+class EmbeddingError(Exception):
+    pass
+
+def batch_for_embedding(token_counts, max_inputs=MAX_INPUTS_PER_REQUEST, max_tokens=MAX_TOKENS_PER_REQUEST):
+    batch = []
+    batch_tokens = 0
+
+    for index, count in enumerate(token_counts):
+        if batch and (len(batch) == max_inputs or batch_tokens + count > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+
+        batch.append(index)
+        batch_tokens += count
+
+    if batch:
+        yield batch
+
+def request_embeddings(inputs, dim: int, max_retries: int = 5, backoff: float = 1.0, timeout: float = 60.0):
+
     headers = {
        "Content-Type": "application/json",
        "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"
     }
-    
+
     data = {
-       "input": text,
-       "model": "text-embedding-3-small",
+       "input": inputs,
+       "model": EMBEDDING_MODEL,
        "dimensions": dim
     }
-    
-    try:
-        response = requests.post("https://api.openai.com/v1/embeddings", headers=headers, json=data)
-        if response.status_code == 200:
-            data = response.json()
-            embedding = data['data'][0]['embedding']
 
-            return embedding
-        else:
-            print(f"Error: API request failed with status code {response.status_code}")
+    for attempt in range(max_retries + 1):
+        retry_after = None
+
+        try:
+            response = requests.post(
+                os.getenv('OPENAI_EMBEDDINGS_URL', EMBEDDING_URL),
+                headers=headers,
+                json=data,
+                timeout=timeout
+            )
+
+            if response.status_code == 200:
+                items = sorted(response.json()['data'], key=lambda item: item['index'])
+                if len(items) != len(inputs):
+                    raise EmbeddingError(f"Expected {len(inputs)} embeddings, got {len(items)}")
+                return [item['embedding'] for item in items]
+
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                raise EmbeddingError(
+                    f"API request failed with status code {response.status_code}: {response.text[:200]}"
+                )
+
+            error = f"status code {response.status_code}"
+            retry_after = response.headers.get('Retry-After')
+
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+
+        if attempt == max_retries:
+            raise EmbeddingError(f"API request failed after {max_retries + 1} attempts: {error}")
+
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = backoff * (2 ** attempt) * (0.5 + random.random())
+
+        time.sleep(delay)
+
+def truncate_to_tokens (text: str, max_tokens: int) :
+    encoder = get_encoder()
+    tokens, truncated = encode_prefix(text, max_tokens, encoder)
+
+    if not truncated:
+        return text
+    return encoder.decode(tokens)
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error: An error occurred during the request: {e}")
+def embed_texts_openAI (texts: list, dim: int, max_retries: int = 5, use_cache: bool = True) :
 
-def tokenize_and_embed_text (text : str, chunk_size: int, overlap: float, dim: int) :
+    cache = get_embedding_cache() if use_cache else None
+    cached = cache.get_many(EMBEDDING_MODEL, dim, texts) if cache else {}
 
+    # Only texts that missed the cache go over the network, each one once
+    pending = [text for text in dict.fromkeys(texts) if text not in cached]
+
+    if pending:
+        encoder = get_encoder()
+
+        inputs = []
+        token_counts = []
+        for text in pending:
+            # Over-long inputs are rejected outright by the API, so trim them here
+            tokens, truncated = encode_prefix(text, MAX_TOKENS_PER_INPUT, encoder)
+            if truncated:
+                text = encoder.decode(tokens)
+            inputs.append(text)
+            token_counts.append(len(tokens))
+
+        fetched = {}
+        for batch in batch_for_embedding(token_counts):
+            with stage('embed'):
+                results = request_embeddings([inputs[i] for i in batch], dim, max_retries=max_retries)
+            for index, embedding in zip(batch, results):
+                fetched[pending[index]] = embedding
+
+        if cache:
+            cache.put_many(EMBEDDING_MODEL, dim, fetched)
+        cached.update(fetched)
+
+    return [cached[text] for text in texts]
+
+def embed_text_openAI (text: str, dim: int, use_cache: bool = True) :
+    return embed_texts_openAI([text], dim, use_cache=use_cache)[0]
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str = "gpt-3.5-turbo"):
+    return tiktoken.encoding_for_model(model)
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n')
+CONTENT_BOUNDARY_EVERY = 4
+PIECE_BOUNDARY = re.compile(r'\n(?=\S)')
+MAX_PIECE_CHARS = 1 << 16
+
+def iter_lines(text: str):
+    # Like splitlines(keepends=True) on newlines, without building the list
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        end = len(text) if end == -1 else end + 1
+        yield text[start:end]
+        start = end
+
+def iter_pieces(text: str, max_chars: int = MAX_PIECE_CHARS):
+    # Pieces end at a newline or single space followed by a non-space, which
+    # always ends a BPE pre-token, so encoding piece by piece gives the same
+    # tokens as encoding the whole text. A line is only cut when it runs past
+    # max_chars, and only hard-cut when it has no such space.
+    start = 0
+    for match in PIECE_BOUNDARY.finditer(text):
+        yield from split_long_piece(text[start:match.end()], max_chars)
+        start = match.end()
+    if start < len(text):
+        yield from split_long_piece(text[start:], max_chars)
+
+def split_long_piece(piece: str, max_chars: int):
+    while len(piece) > max_chars:
+        cut = piece.rfind(' ', 1, max_chars)
+        while cut > 0 and (piece[cut - 1].isspace() or cut + 1 >= len(piece) or piece[cut + 1].isspace()):
+            cut = piece.rfind(' ', 1, cut)
+        cut = max_chars if cut <= 0 else cut
+        yield piece[:cut]
+        piece = piece[cut:]
+    yield piece
+
+def encode_prefix(text: str, max_tokens: int, encoder=None):
+    # Tokens of at most the first max_tokens of text, and whether it was cut;
+    # encoding stops as soon as that many are in hand
+    encoder = encoder or get_encoder()
+
+    tokens = []
+    for piece in iter_pieces(text):
+        tokens.extend(encoder.encode(piece))
+        if len(tokens) > max_tokens:
+            return tokens[:max_tokens], True
+    return tokens, False
+
+def iter_segments(text: str, mode: str):
+    if mode == 'paragraph':
+        yield from iter_lines(text)
+        return
+
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        yield text[start:match.end()]
+        start = match.end()
+    if start < len(text):
+        yield text[start:]
+
+def iter_token_chunks(text: str, chunk_size: int, overlap: float, encoder=None):
+    # Windows of chunk_size tokens that advance by chunk_size * overlap tokens.
+    # Pieces are encoded one at a time as they are read, so only about one
+    # window of tokens is held at once.
+    encoder = encoder or get_encoder()
+    offset = max(1, int(chunk_size * overlap))
+
+    buffer = []
+    for piece in iter_pieces(text):
+        buffer.extend(encoder.encode(piece))
+
+        while len(buffer) > chunk_size:
+            yield encoder.decode(buffer[:chunk_size])
+            del buffer[:offset]
+
+    if buffer:
+        yield encoder.decode(buffer)
+
+def iter_segment_chunks(text: str, chunk_size: int, overlap: float, mode: str, encoder=None):
+    # Packs whole sentences or paragraphs into chunks of at most chunk_size tokens;
+    # trailing segments are repeated in the next chunk to keep the same overlap
+    encoder = encoder or get_encoder()
+    keep = chunk_size - max(1, int(chunk_size * overlap))
+
+    window = deque()
+    total = 0
+    fresh = False
+    for segment in iter_segments(text, mode):
+        count = len(encoder.encode(segment))
+
+        if count > chunk_size:
+            if fresh:
+                yield "".join(part for part, _ in window).strip()
+            window.clear()
+            total = 0
+            fresh = False
+            yield from iter_token_chunks(segment, chunk_size, overlap, encoder)
+            continue
+
+        if window and total + count > chunk_size:
+            if fresh:
+                yield "".join(part for part, _ in window).strip()
+                fresh = False
+            while window and (total > keep or total + count > chunk_size):
+                total -= window.popleft()[1]
+
+        window.append((segment, count))
+        total += count
+        fresh = True
+
+    if fresh:
+        yield "".join(part for part, _ in window).strip()
+
+def iter_content_blocks(text: str, size: int, encoder=None):
+    # Runs of whole sentences of roughly size tokens. A block ends after a
+    # sentence whose own hash picks it, once the block holds half of size, so
+    # where blocks end depends only on nearby text and not on its offset.
+    encoder = encoder or get_encoder()
+    min_size = max(1, size // 2)
+    max_size = max(min_size, 2 * size)
+
+    block = []
+    total = 0
+    for segment in iter_segments(text, 'sentence'):
+        count = len(encoder.encode(segment))
+
+        if count > max_size:
+            if block:
+                yield "".join(block), total
+            block, total = [], 0
+            for piece in iter_token_chunks(segment, max_size, 1.0, encoder):
+                yield piece, len(encoder.encode(piece))
+            continue
+
+        if block and total + count > max_size:
+            yield "".join(block), total
+            block, total = [], 0
+
+        block.append(segment)
+        total += count
+
+        digest = hashlib.blake2b(segment.strip().encode('utf-8'), digest_size=4).digest()
+        if total >= min_size and int.from_bytes(digest, 'little') % CONTENT_BOUNDARY_EVERY == 0:
+            yield "".join(block), total
+            block, total = [], 0
+
+    if block:
+        yield "".join(block), total
+
+def iter_content_chunks(text: str, chunk_size: int, overlap: float, encoder=None):
+    # Each chunk is the longest run of blocks that fits in chunk_size, one per
+    # block it advances past, so like token windows they move on by about
+    # chunk_size * overlap tokens. An edit only changes the chunks holding the
+    # blocks it touched, which is what keeps re-crawls incremental.
+    encoder = encoder or get_encoder()
+    size = max(1, int(chunk_size * overlap))
+
+    window = deque()
+    total = 0
+    for block, count in iter_content_blocks(text, min(size, chunk_size // 2), encoder):
+        if window and total + count > chunk_size:
+            yield "".join(part for part, _ in window).strip()
+            while window and total + count > chunk_size:
+                total -= window.popleft()[1]
+
+        window.append((block, count))
+        total += count
+
+    if window:
+        yield "".join(part for part, _ in window).strip()
+
+def iter_text_chunks(text: str, chunk_size: int, overlap: float, mode: str = 'tokens'):
     assert (overlap < 1.0)
     assert (overlap > 0.0)
 
-    offset = int(chunk_size * overlap)
-    end = chunk_size
-    encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    encodings = encoder.encode(text)
-    
-    start = 0
-    lengthOfEncodings = len(encodings)
-    TokenEmbeddingMatrix = list()
-    while start < lengthOfEncodings :
+    if mode == 'tokens':
+        return iter_token_chunks(text, chunk_size, overlap)
+    if mode in ('sentence', 'paragraph'):
+        return iter_segment_chunks(text, chunk_size, overlap, mode)
+    if mode == 'content':
+        return iter_content_chunks(text, chunk_size, overlap)
 
-        end = min(end, lengthOfEncodings)
-        content = encoder.decode(encodings[start:end])
-        TokenEmbeddingMatrix.append((content, embed_text_openAI(content, dim)))
+    raise ValueError(f"Unknown chunking mode: {mode}")
 
-        if end == lengthOfEncodings :
-            break
+def chunk_text (text : str, chunk_size: int, overlap: float, mode: str = 'tokens') :
+    with stage('tokenize'):
+        return [content for content in iter_text_chunks(text, chunk_size, overlap, mode) if content]
 
-        start += offset
-        end += offset
-    
-    return TokenEmbeddingMatrix
+def tokenize_and_embed_text (text : str, chunk_size: int, overlap: float, dim: int, mode: str = 'tokens') :
+
+    contents = chunk_text(text, chunk_size, overlap, mode)
+
+    # Chunk vectors are stored with their chunks and never asked for again, so
+    # they stay out of the cache kept for query-side embeddings
+    return list(zip(contents, embed_texts_openAI(contents, dim, use_cache=False)))
 
 # def LLM_Agent_for_title_desc (heads, content) :
 
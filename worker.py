@@ -0,0 +1,63 @@
+import os
+import time
+import signal
+from functools import partial
+from dotenv import load_dotenv
+from ingest import IngestScheduler
+from jobqueue import claim_jobs
+from processURL import run_job, ensure_ingest_schema, WORKER_ID
+from utilities import fetch_pages
+
+load_dotenv()
+
+POLL_INTERVAL = float(os.getenv('INGEST_POLL_INTERVAL', 5))
+
+def main():
+    ensure_ingest_schema()
+
+    scheduler = IngestScheduler(
+        workers=int(os.getenv('INGEST_WORKERS', 4)),
+        max_queued=int(os.getenv('INGEST_MAX_QUEUED', 100)),
+        per_host=int(os.getenv('INGEST_PER_HOST', 1)),
+        host_delay=float(os.getenv('INGEST_HOST_DELAY', 1.0))
+    )
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"Worker {WORKER_ID} polling the queue")
+
+    while not stopping:
+        # Only lease as many jobs as there are idle threads to start them, so a
+        # claimed job never waits out its lease in the local backlog
+        stats = scheduler.stats()
+        free = stats['workers'] - stats['running'] - stats['queued']
+        jobs = []
+
+        if free > 0:
+            try:
+                jobs = claim_jobs(WORKER_ID, free)
+            except Exception as e:
+                print(f"Error claiming jobs: {e}")
+
+        # The claimed pages are fetched together on the shared event loop; the
+        # pool threads then only parse, embed and write
+        pages = fetch_pages([url for _, url, _, _ in jobs]) if jobs else []
+
+        for (job_id, url, user_id, attempts), page in zip(jobs, pages):
+            scheduler.submit([url], user_id, handler=partial(run_job, job_id, attempts, page=page))
+
+        if not jobs:
+            time.sleep(POLL_INTERVAL)
+
+    print(f"Worker {WORKER_ID} draining in-flight jobs")
+    scheduler.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    main()